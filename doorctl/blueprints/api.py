@@ -1,18 +1,343 @@
 # Filename    : api.py
 # Author      : Jon Kelley <jon.kelley@kzoomakers.org>
 # Description : REST API endpoints for door control system
-import requests
-from flask import Blueprint, request, jsonify, current_app, send_file
+from flask import Blueprint, Response, request, jsonify, current_app, send_file, stream_with_context
 from functools import wraps
-from doorctl.db import db, CardMemberMapping, GlobalEventLog
+from operator import attrgetter
+from doorctl.db import db, CardMemberMapping, GlobalEventLog, insert_ignoring_conflicts, insert_unless_exists
+from doorctl.sharedlib.cache import cache_manager
+from doorctl.sharedlib.event_import import prepare_event_rows
+from doorctl.sharedlib.get_config import get_uhppoted_config
+from doorctl.sharedlib.http_session import session as http_session, fan_out, response_error, REQUEST_TIMEOUT
+from doorctl.sharedlib.json_stream import json_array
+from sqlalchemy import and_, insert, or_, select
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 import datetime
-import json
-import io
+import fcntl
+import hashlib
+import hmac
+import orjson
+import os
+import re
+import threading
+import time
+import uuid
 
 api = Blueprint('api', __name__, url_prefix='/api/v1')
 
+# Rows are fetched from the database in batches of this size when listing/exporting
+YIELD_PER = 1000
+
+# Rows per multi-row INSERT when importing
+IMPORT_BATCH_SIZE = 500
+
+# Rows per executemany batch when importing events (not bound by the
+# per-statement parameter limit that caps multi-row INSERTs)
+IMPORT_EVENT_BATCH_SIZE = 1000
+
+# Background exports are written here and kept for EXPORT_RETENTION seconds
+EXPORT_DIR = os.environ.get('EXPORT_DIR', '/tmp/door_control_exports')
+EXPORT_RETENTION = int(os.environ.get('EXPORT_RETENTION', '3600'))
+
+# Imported events matching a stored event on these fields are duplicates
+EVENT_KEY_FIELDS = ('controller_id', 'event_id', 'timestamp')
+
+# Import INSERTs are built once and reused (SQLAlchemy caches their compiled form)
+EVENT_INSERT = insert(GlobalEventLog)
+EVENT_INSERT_UNLESS_EXISTS = insert_unless_exists(GlobalEventLog, EVENT_KEY_FIELDS)
+
+# Controller door numbers with their keys in the card 'doors' object
+DOORS = tuple((door, str(door)) for door in range(1, 5))
+
+# Fields returned for users and events, in response order
+USER_FIELDS = ('id', 'card_number', 'name', 'email', 'phone', 'login', 'uid', 'note', 'membership_type')
+
+EVENT_FIELDS = (
+    'id', 'controller_id', 'event_id', 'timestamp', 'timestamp_utc', 'card_number',
+    'event_type', 'event_type_text', 'access_granted', 'door_id', 'direction',
+    'direction_text', 'event_reason', 'event_reason_text', 'name', 'email', 'membership_type'
+)
+
+EVENT_EXPORT_FIELDS = (
+    'id', 'controller_id', 'event_id', 'timestamp', 'timestamp_utc', 'card_number',
+    'event_type', 'event_type_text', 'access_granted', 'door_id', 'direction',
+    'direction_text', 'event_reason', 'event_reason_text', 'insert_timestamp_utc',
+    'name', 'email', 'membership_type'
+)
+
+# Columns selected when serializing rows straight from the database (no ORM instances)
+USER_COLUMNS = tuple(getattr(CardMemberMapping, field) for field in USER_FIELDS)
+EVENT_COLUMNS = tuple(getattr(GlobalEventLog, field) for field in EVENT_FIELDS)
+EVENT_EXPORT_COLUMNS = tuple(getattr(GlobalEventLog, field) for field in EVENT_EXPORT_FIELDS)
+
+_user_values = attrgetter(*USER_FIELDS)
+_event_values = attrgetter(*EVENT_FIELDS)
+
+
+def serialize_user(user):
+    """Convert a CardMemberMapping instance to a response dict"""
+    return dict(zip(USER_FIELDS, _user_values(user)))
+
+
+def serialize_event(event):
+    """Convert a GlobalEventLog instance to a response dict"""
+    return dict(zip(EVENT_FIELDS, _event_values(event)))
+
+
+def iter_rows(*columns):
+    """Yield a plain dict per row for the given columns, fetched in YIELD_PER batches"""
+    stmt = select(*columns).execution_options(yield_per=YIELD_PER)
+    for row in db.session.execute(stmt):
+        yield dict(row._mapping)
+
+
+def export_chunks(export_metadata, include_events):
+    """
+    Encode the export document, yielding bytes chunks
+
+    Rows are encoded as they come off the cursor, so the full dataset is
+    never held in memory
+    """
+    yield b'{"export_metadata":' + orjson.dumps(export_metadata) + b',"users":'
+    yield from json_array(iter_rows(*USER_COLUMNS), YIELD_PER)
+    if include_events:
+        yield b',"events":'
+        yield from json_array(iter_rows(*EVENT_EXPORT_COLUMNS), YIELD_PER)
+    yield b'}'
+
+
+def _export_path(job_id, suffix=''):
+    return os.path.join(EXPORT_DIR, f'{job_id}.json{suffix}')
+
+
+def _run_export_job(app, job_id, export_metadata, include_events):
+    """Write an export to EXPORT_DIR, runs on a background thread"""
+    part_path = _export_path(job_id, '.part')
+    try:
+        with app.app_context():
+            with open(part_path, 'wb') as f:
+                # Held until the export is renamed into place, marks the job as live
+                # for _purge_old_exports in every worker
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                for chunk in export_chunks(export_metadata, include_events):
+                    f.write(chunk)
+                os.replace(part_path, _export_path(job_id))
+    except Exception as e:
+        with open(_export_path(job_id, '.error'), 'w') as f:
+            f.write(str(e))
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+
+def _purge_old_exports():
+    """
+    Remove exports (and stale partial files) older than EXPORT_RETENTION
+
+    Partial files of jobs still running are kept, whatever their age
+    """
+    cutoff = time.time() - EXPORT_RETENTION
+    for entry in os.scandir(EXPORT_DIR):
+        # Another request may be purging the same files concurrently
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            if entry.name.endswith('.part'):
+                _remove_abandoned_part(entry.path)
+            else:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+
+def _remove_abandoned_part(path):
+    """Remove a partial export unless its job still holds the lock on it"""
+    with open(path, 'rb') as f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        os.remove(path)
+
+
+def _export_job_status(job_id):
+    """
+    Look up a background export from its files in EXPORT_DIR
+
+    Job state lives on disk rather than in memory so every worker process
+    sees the same jobs
+
+    Returns:
+        Tuple of (status, error message); status is None for unknown jobs
+    """
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None, None
+    if os.path.exists(_export_path(job_id)):
+        return 'complete', None
+    if os.path.exists(_export_path(job_id, '.part')):
+        return 'running', None
+    if os.path.exists(_export_path(job_id, '.error')):
+        with open(_export_path(job_id, '.error')) as f:
+            return 'failed', f.read()
+    return None, None
+
+
+def import_events_are_new(events_data):
+    """
+    Check whether none of the imported events can be a duplicate
+
+    True when the payload has no repeated (controller_id, event_id, timestamp)
+    key and nothing is stored yet for its controllers, e.g. importing a new
+    controller's history. One indexed probe instead of a check per row.
+    """
+    keys = {
+        (event_data.get('controller_id'), event_data.get('event_id'), event_data.get('timestamp'))
+        for event_data in events_data
+    }
+    if len(keys) != len(events_data):
+        return False
+
+    controller_ids = {key[0] for key in keys}
+    if None in controller_ids:
+        return False
+
+    stored = db.session.execute(
+        select(GlobalEventLog.id).where(GlobalEventLog.controller_id.in_(controller_ids)).limit(1)
+    ).first()
+    return stored is None
+
+
+def import_shape_error(import_data):
+    """
+    Check the shape of an import document before anything is written
+
+    Shared by the API import and the web UI import, so neither fails part way
+    through its batches on a malformed row
+
+    Returns:
+        Error message, or None when "users" and "events" are arrays of objects
+    """
+    if not isinstance(import_data, dict):
+        return 'Import data must be a JSON object'
+    for name in ('users', 'events'):
+        rows = import_data.get(name, [])
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return f'"{name}" must be an array of objects'
+    return None
+
+
+def import_rows(users_data, events_data, mode, skip_duplicates, results):
+    """
+    Insert imported users and events with batched INSERTs, committing per batch
+
+    Shared by the API import and the web UI import
+
+    Args:
+        users_data: List of user dicts as found in an export
+        events_data: List of event dicts as found in an export
+        mode: 'merge' or 'replace' (existing data is cleared by the caller)
+        skip_duplicates: In merge mode, skip users/events that are already stored
+        results: {'users': {...}, 'events': {...}} counters, updated in place
+    """
+    # Import users in batches; in merge mode rows whose card_number already
+    # exists are skipped by the database instead of a SELECT per user
+    skip_existing_users = skip_duplicates and mode == 'merge'
+    if skip_existing_users:
+        users_stmt = insert_ignoring_conflicts(CardMemberMapping, ['card_number'])
+    else:
+        users_stmt = insert(CardMemberMapping)
+
+    for start in range(0, len(users_data), IMPORT_BATCH_SIZE):
+        batch = [{
+            'card_number': user_data.get('card_number'),
+            'name': user_data.get('name'),
+            'email': user_data.get('email'),
+            'phone': user_data.get('phone'),
+            'login': user_data.get('login'),
+            'uid': user_data.get('uid'),
+            'note': user_data.get('note'),
+            'membership_type': user_data.get('membership_type')
+        } for user_data in users_data[start:start + IMPORT_BATCH_SIZE]]
+
+        added = db.session.execute(users_stmt.values(batch)).rowcount
+        db.session.commit()
+        results['users']['added'] += added
+        results['users']['skipped'] += len(batch) - added
+
+    # Import events if provided, in batches
+    # In merge mode events already stored (or earlier in this import) are
+    # skipped by the INSERT itself, no lookup beforehand
+    skip_existing_events = skip_duplicates and mode == 'merge' and not import_events_are_new(events_data)
+    events_stmt = EVENT_INSERT_UNLESS_EXISTS if skip_existing_events else EVENT_INSERT
+
+    for start in range(0, len(events_data), IMPORT_EVENT_BATCH_SIZE):
+        event_rows, event_errors = prepare_event_rows(events_data[start:start + IMPORT_EVENT_BATCH_SIZE])
+        results['events']['errors'].extend(event_errors)
+        if not event_rows:
+            continue
+
+        if skip_existing_events:
+            added = db.session.execute(events_stmt, event_rows).rowcount
+        else:
+            db.session.execute(events_stmt, event_rows)
+            added = len(event_rows)
+        db.session.commit()
+        results['events']['added'] += added
+        results['events']['skipped'] += len(event_rows) - added
+
+
+def card_url_template(card_number):
+    """
+    Build a formatter for the per-controller URL of card_number
+
+    Returns:
+        Callable taking a controller ID and returning the card URL on that controller
+    """
+    return (current_app.config['REST_ENDPOINT'] + '/device/{}/card/' + str(card_number)).format
+
+
+def invalidate_card_caches(card_number, controller_ids):
+    """Drop the cached copies of a card (and the card lists) after writing it to controllers"""
+    for controller_id in controller_ids:
+        cache_manager.invalidate(f"controller_{controller_id}_card_{card_number}")
+        cache_manager.invalidate(f"controller_{controller_id}_cards_list")
+    cache_manager.invalidate("global_cards_aggregated")
+
+
+def encode_event_cursor(event):
+    """Build the opaque keyset cursor pointing just after event"""
+    # Events without a timestamp get an empty timestamp part
+    timestamp = event.timestamp_utc.isoformat() if event.timestamp_utc else ''
+    return f"{timestamp}_{event.id}"
+
+
+def decode_event_cursor(cursor):
+    """
+    Parse a cursor produced by encode_event_cursor
+
+    Returns:
+        (timestamp_utc, id) tuple, timestamp_utc is None for events without one
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    timestamp, separator, event_id = cursor.rpartition('_')
+    if not separator:
+        raise ValueError(f'invalid cursor: {cursor}')
+    return (datetime.datetime.fromisoformat(timestamp) if timestamp else None), int(event_id)
+
+# Auth failures are answered from pre-encoded bodies, they never change
+_MISSING_API_KEY = orjson.dumps({
+    'error': 'Missing API key',
+    'message': 'X-API-Key header is required'
+})
+_INVALID_API_KEY = orjson.dumps({
+    'error': 'Invalid API key',
+    'message': 'The provided API key is not valid'
+})
+
 def require_api_key(f):
     """Decorator to require API key authentication"""
     @wraps(f)
@@ -20,16 +345,15 @@ def require_api_key(f):
         api_key = request.headers.get('X-API-Key')
         
         if not api_key:
-            return jsonify({
-                'error': 'Missing API key',
-                'message': 'X-API-Key header is required'
-            }), 401
+            return Response(_MISSING_API_KEY, 401, mimetype='application/json')
         
-        if api_key != current_app.config.get('API_KEY'):
-            return jsonify({
-                'error': 'Invalid API key',
-                'message': 'The provided API key is not valid'
-            }), 403
+        # Read from the current app on every request, so each app instance (and
+        # a config change) is checked against its own key
+        configured_key = (current_app.config.get('API_KEY') or '').encode()
+        
+        # Constant-time compare so the key can't be guessed from response timing
+        if not configured_key or not hmac.compare_digest(api_key.encode(), configured_key):
+            return Response(_INVALID_API_KEY, 403, mimetype='application/json')
         
         return f(*args, **kwargs)
     return decorated_function
@@ -47,21 +371,7 @@ def list_users():
         JSON array of all users with their details
     """
     try:
-        users = CardMemberMapping.query.all()
-        users_list = []
-        
-        for user in users:
-            users_list.append({
-                'id': user.id,
-                'card_number': user.card_number,
-                'name': user.name,
-                'email': user.email,
-                'phone': user.phone,
-                'login': user.login,
-                'uid': user.uid,
-                'note': user.note,
-                'membership_type': user.membership_type
-            })
+        users_list = list(iter_rows(*USER_COLUMNS))
         
         return jsonify({
             'success': True,
@@ -90,7 +400,7 @@ def get_user(user_id):
         JSON object with user details
     """
     try:
-        user = CardMemberMapping.query.get(user_id)
+        user = db.session.get(CardMemberMapping, user_id)
         
         if not user:
             return jsonify({
@@ -101,17 +411,7 @@ def get_user(user_id):
         
         return jsonify({
             'success': True,
-            'user': {
-                'id': user.id,
-                'card_number': user.card_number,
-                'name': user.name,
-                'email': user.email,
-                'phone': user.phone,
-                'login': user.login,
-                'uid': user.uid,
-                'note': user.note,
-                'membership_type': user.membership_type
-            }
+            'user': serialize_user(user)
         }), 200
     
     except Exception as e:
@@ -195,17 +495,7 @@ def create_user():
         return jsonify({
             'success': True,
             'message': 'User created successfully',
-            'user': {
-                'id': new_user.id,
-                'card_number': new_user.card_number,
-                'name': new_user.name,
-                'email': new_user.email,
-                'phone': new_user.phone,
-                'login': new_user.login,
-                'uid': new_user.uid,
-                'note': new_user.note,
-                'membership_type': new_user.membership_type
-            }
+            'user': serialize_user(new_user)
         }), 201
     
     except IntegrityError as e:
@@ -249,7 +539,7 @@ def update_user(user_id):
         JSON object with updated user details
     """
     try:
-        user = CardMemberMapping.query.get(user_id)
+        user = db.session.get(CardMemberMapping, user_id)
         
         if not user:
             return jsonify({
@@ -288,17 +578,7 @@ def update_user(user_id):
         return jsonify({
             'success': True,
             'message': 'User updated successfully',
-            'user': {
-                'id': user.id,
-                'card_number': user.card_number,
-                'name': user.name,
-                'email': user.email,
-                'phone': user.phone,
-                'login': user.login,
-                'uid': user.uid,
-                'note': user.note,
-                'membership_type': user.membership_type
-            }
+            'user': serialize_user(user)
         }), 200
     
     except Exception as e:
@@ -323,7 +603,7 @@ def delete_user(user_id):
         JSON confirmation message
     """
     try:
-        user = CardMemberMapping.query.get(user_id)
+        user = db.session.get(CardMemberMapping, user_id)
         
         if not user:
             return jsonify({
@@ -375,7 +655,7 @@ def activate_user_access(user_id):
         JSON object with activation results for each controller
     """
     try:
-        user = CardMemberMapping.query.get(user_id)
+        user = db.session.get(CardMemberMapping, user_id)
         
         if not user:
             return jsonify({
@@ -387,40 +667,45 @@ def activate_user_access(user_id):
         data = request.get_json() or {}
         
         # Set default dates
-        start_date = data.get('start_date', datetime.date.today().strftime('%Y-%m-%d'))
-        end_date = data.get('end_date', (datetime.date.today() + datetime.timedelta(days=365)).strftime('%Y-%m-%d'))
+        today = datetime.date.today()
+        start_date = data.get('start_date') or today.isoformat()
+        end_date = data.get('end_date') or (today + datetime.timedelta(days=365)).isoformat()
         
         # Get door configuration
         doors_list = data.get('doors', [1, 2, 3, 4])
         pin = data.get('pin')
         
         # Get all controllers from config
-        from doorctl.sharedlib.get_config import parse_uhppoted_config
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
+        
+        # Build card data (identical for every controller)
+        card_number = user.card_number
+        doors_set = frozenset(doors_list)
+        card_data = {
+            'card-number': card_number,
+            'start-date': start_date,
+            'end-date': end_date,
+            # Set door permissions
+            'doors': {key: int(door in doors_set) for door, key in DOORS}
+        }
+        
+        if pin:
+            card_data['pin'] = int(pin)
+        
+        # Send requests to all controllers concurrently
+        card_url = card_url_template(card_number)
+        responses = fan_out(
+            lambda controller_id: http_session.put(
+                card_url(controller_id),
+                json=card_data, timeout=REQUEST_TIMEOUT),
+            api_config['devices'].keys()
+        )
+        invalidate_card_caches(card_number, api_config['devices'].keys())
         
         results = []
         success_count = 0
         
-        for controller_id in api_config['devices'].keys():
-            # Build card data
-            card_data = {
-                'card-number': user.card_number,
-                'start-date': start_date,
-                'end-date': end_date,
-                'doors': {}
-            }
-            
-            # Set door permissions
-            for i in range(1, 5):
-                card_data['doors'][str(i)] = 1 if i in doors_list else 0
-            
-            if pin:
-                card_data['pin'] = int(pin)
-            
-            # Send request to controller
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{user.card_number}"
-            response = requests.put(url, json=card_data)
-            
+        for controller_id, response in responses:
             if response.status_code == 200:
                 success_count += 1
                 results.append({
@@ -432,7 +717,7 @@ def activate_user_access(user_id):
                 results.append({
                     'controller_id': controller_id,
                     'success': False,
-                    'message': response.json().get('message', 'Failed to activate access')
+                    'message': response_error(response, 'Failed to activate access')
                 })
         
         return jsonify({
@@ -467,7 +752,7 @@ def deactivate_user_access(user_id):
         JSON object with deactivation results for each controller
     """
     try:
-        user = CardMemberMapping.query.get(user_id)
+        user = db.session.get(CardMemberMapping, user_id)
         
         if not user:
             return jsonify({
@@ -477,17 +762,23 @@ def deactivate_user_access(user_id):
             }), 404
         
         # Get all controllers from config
-        from doorctl.sharedlib.get_config import parse_uhppoted_config
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
+        
+        # Send DELETE requests to remove card from all controllers concurrently
+        card_number = user.card_number
+        card_url = card_url_template(card_number)
+        responses = fan_out(
+            lambda controller_id: http_session.delete(
+                card_url(controller_id),
+                timeout=REQUEST_TIMEOUT),
+            api_config['devices'].keys()
+        )
+        invalidate_card_caches(card_number, api_config['devices'].keys())
         
         results = []
         success_count = 0
         
-        for controller_id in api_config['devices'].keys():
-            # Send DELETE request to remove card from controller
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{user.card_number}"
-            response = requests.delete(url)
-            
+        for controller_id, response in responses:
             if response.status_code == 200:
                 success_count += 1
                 results.append({
@@ -499,7 +790,7 @@ def deactivate_user_access(user_id):
                 results.append({
                     'controller_id': controller_id,
                     'success': False,
-                    'message': response.json().get('message', 'Failed to deactivate access')
+                    'message': response_error(response, 'Failed to deactivate access')
                 })
         
         return jsonify({
@@ -535,15 +826,19 @@ def get_card_access_status(card_number):
     """
     try:
         # Get all controllers from config
-        from doorctl.sharedlib.get_config import parse_uhppoted_config
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
+        
+        card_url = card_url_template(card_number)
+        responses = fan_out(
+            lambda controller_id: http_session.get(
+                card_url(controller_id),
+                timeout=REQUEST_TIMEOUT),
+            api_config['devices'].keys()
+        )
         
         results = []
         
-        for controller_id in api_config['devices'].keys():
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-            response = requests.get(url)
-            
+        for controller_id, response in responses:
             if response.status_code == 200:
                 card_info = response.json().get('card', {})
                 results.append({
@@ -587,7 +882,9 @@ def get_events():
         card_number: Filter by card number
         door_id: Filter by door ID
         limit: Maximum number of events to return (default: 100)
-        offset: Number of events to skip (default: 0)
+        cursor: next_cursor from a previous page (keyset pagination, skips the total count)
+        offset: Number of events to skip (default: 0, ignored when cursor is given)
+        format: 'ndjson' to stream one event per line instead of a JSON document
     
     Returns:
         JSON array of events
@@ -611,49 +908,67 @@ def get_events():
         # Apply pagination
         limit = request.args.get('limit', 100, type=int)
         offset = request.args.get('offset', 0, type=int)
+        cursor = request.args.get('cursor')
         
-        # Limit maximum results
-        limit = min(limit, 1000)
+        # Limit maximum results (and keep at least one, so a cursor can be built)
+        limit = max(1, min(limit, 1000))
         
-        # Order by most recent first
-        query = query.order_by(GlobalEventLog.timestamp_utc.desc())
+        # Order by most recent first (id breaks ties between identical timestamps)
+        query = query.order_by(GlobalEventLog.timestamp_utc.desc(), GlobalEventLog.id.desc())
         
-        # Get total count before pagination
-        total_count = query.count()
+        if cursor:
+            try:
+                cursor_ts, cursor_id = decode_event_cursor(cursor)
+            except ValueError:
+                return jsonify({
+                    'success': False,
+                    'error': 'Invalid cursor',
+                    'message': 'cursor must be a next_cursor value from a previous response'
+                }), 400
+            
+            # Seek past the cursor using the (timestamp_utc) indexes instead of OFFSET.
+            # Events without a timestamp sort last, after every timestamped one
+            if cursor_ts is None:
+                query = query.filter(and_(GlobalEventLog.timestamp_utc.is_(None), GlobalEventLog.id < cursor_id))
+            else:
+                query = query.filter(or_(
+                    GlobalEventLog.timestamp_utc < cursor_ts,
+                    and_(GlobalEventLog.timestamp_utc == cursor_ts, GlobalEventLog.id < cursor_id),
+                    GlobalEventLog.timestamp_utc.is_(None)
+                ))
+            offset = 0
+        
+        if request.args.get('format') == 'ndjson':
+            # One JSON object per line, encoded as rows come off the cursor
+            rows = query.with_entities(*EVENT_COLUMNS).offset(offset).limit(limit).yield_per(YIELD_PER)
+            
+            def generate():
+                for row in rows:
+                    yield orjson.dumps(dict(row._mapping)) + b'\n'
+            
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        
+        # Get total count before pagination (skipped when paging by cursor)
+        total_count = None if cursor else query.count()
         
         # Apply pagination
-        events = query.limit(limit).offset(offset).all()
-        
-        events_list = []
-        for event in events:
-            events_list.append({
-                'id': event.id,
-                'controller_id': event.controller_id,
-                'event_id': event.event_id,
-                'timestamp': event.timestamp,
-                'timestamp_utc': event.timestamp_utc.isoformat() if event.timestamp_utc else None,
-                'card_number': event.card_number,
-                'event_type': event.event_type,
-                'event_type_text': event.event_type_text,
-                'access_granted': event.access_granted,
-                'door_id': event.door_id,
-                'direction': event.direction,
-                'direction_text': event.direction_text,
-                'event_reason': event.event_reason,
-                'event_reason_text': event.event_reason_text,
-                'name': event.name,
-                'email': event.email,
-                'membership_type': event.membership_type
-            })
+        events = query.offset(offset).limit(limit).all()
         
-        return jsonify({
+        events_list = [serialize_event(event) for event in events]
+        next_cursor = encode_event_cursor(events[-1]) if events and len(events) == limit else None
+        
+        response = {
             'success': True,
             'count': len(events_list),
-            'total': total_count,
             'limit': limit,
             'offset': offset,
+            'next_cursor': next_cursor,
             'events': events_list
-        }), 200
+        }
+        if total_count is not None:
+            response['total'] = total_count
+        
+        return jsonify(response), 200
     
     except Exception as e:
         return jsonify({
@@ -676,12 +991,52 @@ def health_check():
     return jsonify({
         'success': True,
         'status': 'healthy',
-        'timestamp': datetime.datetime.utcnow().isoformat()
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat()
     }), 200
 
 
 # ===== API Documentation Endpoint =====
 
+# The API documentation never changes at runtime, so it is encoded and hashed once
+_DOCS_BODY = orjson.dumps({
+    'api_version': 'v1',
+    'endpoints': {
+        'users': {
+            'GET /api/v1/users': 'List all users',
+            'GET /api/v1/users/<user_id>': 'Get specific user',
+            'POST /api/v1/users': 'Create new user',
+            'PUT /api/v1/users/<user_id>': 'Update user',
+            'DELETE /api/v1/users/<user_id>': 'Delete user'
+        },
+        'access_control': {
+            'POST /api/v1/users/<user_id>/access/activate': 'Activate user access on all controllers',
+            'POST /api/v1/users/<user_id>/access/deactivate': 'Deactivate user access on all controllers',
+            'GET /api/v1/users/card/<card_number>/access/status': 'Get card access status'
+        },
+        'events': {
+            'GET /api/v1/events': 'Get event logs with optional filtering'
+        },
+        'data_management': {
+            'GET /api/v1/export': 'Export all database data to JSON',
+            'POST /api/v1/export/jobs': 'Start a background export',
+            'GET /api/v1/export/jobs/<job_id>': 'Get background export status',
+            'GET /api/v1/export/jobs/<job_id>/download': 'Download a completed background export',
+            'POST /api/v1/import': 'Import database data from JSON'
+        },
+        'system': {
+            'GET /api/v1/health': 'Health check (no auth required)',
+            'GET /api/v1/docs': 'API documentation (no auth required)'
+        }
+    },
+    'authentication': {
+        'method': 'API Key',
+        'header': 'X-API-Key',
+        'description': 'Include your API key in the X-API-Key header for all authenticated endpoints'
+    }
+})
+_DOCS_ETAG = hashlib.blake2b(_DOCS_BODY, digest_size=16).hexdigest()
+
+
 @api.route('/docs', methods=['GET'])
 def api_docs():
     """
@@ -690,39 +1045,11 @@ def api_docs():
     Returns:
         JSON object with API documentation
     """
-    return jsonify({
-        'api_version': 'v1',
-        'endpoints': {
-            'users': {
-                'GET /api/v1/users': 'List all users',
-                'GET /api/v1/users/<user_id>': 'Get specific user',
-                'POST /api/v1/users': 'Create new user',
-                'PUT /api/v1/users/<user_id>': 'Update user',
-                'DELETE /api/v1/users/<user_id>': 'Delete user'
-            },
-            'access_control': {
-                'POST /api/v1/users/<user_id>/access/activate': 'Activate user access on all controllers',
-                'POST /api/v1/users/<user_id>/access/deactivate': 'Deactivate user access on all controllers',
-                'GET /api/v1/users/card/<card_number>/access/status': 'Get card access status'
-            },
-            'events': {
-                'GET /api/v1/events': 'Get event logs with optional filtering'
-            },
-            'data_management': {
-                'GET /api/v1/export': 'Export all database data to JSON',
-                'POST /api/v1/import': 'Import database data from JSON'
-            },
-            'system': {
-                'GET /api/v1/health': 'Health check (no auth required)',
-                'GET /api/v1/docs': 'API documentation (no auth required)'
-            }
-        },
-        'authentication': {
-            'method': 'API Key',
-            'header': 'X-API-Key',
-            'description': 'Include your API key in the X-API-Key header for all authenticated endpoints'
-        }
-    }), 200
+    response = Response(_DOCS_BODY, mimetype='application/json')
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    response.set_etag(_DOCS_ETAG)
+    # Answers If-None-Match with a 304 and no body
+    return response.make_conditional(request)
 
 
 # ===== Data Export/Import Endpoints =====
@@ -744,73 +1071,73 @@ def export_data():
         include_events = request.args.get('include_events', 'true').lower() == 'true'
         download = request.args.get('download', 'false').lower() == 'true'
         
-        # Export users
-        users = CardMemberMapping.query.all()
-        users_data = []
-        for user in users:
-            users_data.append({
-                'id': user.id,
-                'card_number': user.card_number,
-                'name': user.name,
-                'email': user.email,
-                'phone': user.phone,
-                'login': user.login,
-                'uid': user.uid,
-                'note': user.note,
-                'membership_type': user.membership_type
-            })
-        
-        export_data = {
-            'export_metadata': {
-                'timestamp': datetime.datetime.utcnow().isoformat(),
-                'version': '1.0',
-                'include_events': include_events
-            },
-            'users': users_data
+        export_metadata = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'version': '1.0',
+            'include_events': include_events
         }
         
-        # Export events if requested
-        if include_events:
-            events = GlobalEventLog.query.all()
-            events_data = []
-            for event in events:
-                events_data.append({
-                    'id': event.id,
-                    'controller_id': event.controller_id,
-                    'event_id': event.event_id,
-                    'timestamp': event.timestamp,
-                    'timestamp_utc': event.timestamp_utc.isoformat() if event.timestamp_utc else None,
-                    'card_number': event.card_number,
-                    'event_type': event.event_type,
-                    'event_type_text': event.event_type_text,
-                    'access_granted': event.access_granted,
-                    'door_id': event.door_id,
-                    'direction': event.direction,
-                    'direction_text': event.direction_text,
-                    'event_reason': event.event_reason,
-                    'event_reason_text': event.event_reason_text,
-                    'insert_timestamp_utc': event.insert_timestamp_utc.isoformat() if event.insert_timestamp_utc else None,
-                    'name': event.name,
-                    'email': event.email,
-                    'membership_type': event.membership_type
-                })
-            export_data['events'] = events_data
+        def generate():
+            if not download:
+                yield b'{"success":true,"data":'
+            yield from export_chunks(export_metadata, include_events)
+            if not download:
+                yield b'}'
         
         # Return as downloadable file or JSON response
+        headers = {}
         if download:
-            filename = f"door_control_export_{datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
-            json_str = json.dumps(export_data, indent=2)
-            return send_file(
-                io.BytesIO(json_str.encode('utf-8')),
-                mimetype='application/json',
-                as_attachment=True,
-                download_name=filename
-            )
-        else:
-            return jsonify({
-                'success': True,
-                'data': export_data
-            }), 200
+            filename = f"door_control_export_{datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%d_%H%M%S')}.json"
+            headers['Content-Disposition'] = f'attachment; filename={filename}'
+        
+        return Response(stream_with_context(generate()), mimetype='application/json', headers=headers)
+    
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': 'Export error',
+            'message': str(e)
+        }), 500
+
+
+@api.route('/export/jobs', methods=['POST'])
+@require_api_key
+def start_export_job():
+    """
+    Start writing an export file in the background
+    
+    Query Parameters:
+        include_events: If 'false', excludes event logs (default: true)
+    
+    Returns:
+        JSON object with the job ID to poll
+    """
+    try:
+        include_events = request.args.get('include_events', 'true').lower() == 'true'
+        
+        export_metadata = {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'version': '1.0',
+            'include_events': include_events
+        }
+        
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        _purge_old_exports()
+        
+        job_id = uuid.uuid4().hex
+        # Create the .part file up front so the job reports as running straight away
+        open(_export_path(job_id, '.part'), 'wb').close()
+        threading.Thread(
+            target=_run_export_job,
+            args=(current_app._get_current_object(), job_id, export_metadata, include_events),
+            daemon=True
+        ).start()
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'running'
+        }), 202
     
     except Exception as e:
         return jsonify({
@@ -820,6 +1147,70 @@ def export_data():
         }), 500
 
 
+@api.route('/export/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def get_export_job(job_id):
+    """
+    Get the status of a background export
+    
+    Args:
+        job_id: ID returned by POST /export/jobs
+    
+    Returns:
+        JSON object with the job status (running, complete or failed)
+    """
+    status, error = _export_job_status(job_id)
+    
+    if status is None:
+        return jsonify({
+            'success': False,
+            'error': 'Export not found',
+            'message': f'No export found with ID {job_id}'
+        }), 404
+    
+    response = {
+        'success': status != 'failed',
+        'job_id': job_id,
+        'status': status
+    }
+    if error:
+        response['message'] = error
+    
+    return jsonify(response), 200
+
+
+@api.route('/export/jobs/<job_id>/download', methods=['GET'])
+@require_api_key
+def download_export_job(job_id):
+    """
+    Download the file written by a completed background export
+    
+    Args:
+        job_id: ID returned by POST /export/jobs
+    
+    Returns:
+        JSON file as an attachment (supports conditional and range requests)
+    """
+    status, error = _export_job_status(job_id)
+    
+    if status != 'complete':
+        return jsonify({
+            'success': False,
+            'error': 'Export not available',
+            'message': f'Export {job_id} is {status or "not found"}'
+        }), 404 if status is None else 409
+    
+    path = _export_path(job_id)
+    created = datetime.datetime.fromtimestamp(os.path.getmtime(path), datetime.timezone.utc)
+    return send_file(
+        path,
+        mimetype='application/json',
+        as_attachment=True,
+        download_name=f"door_control_export_{created.strftime('%Y%m%d_%H%M%S')}.json",
+        conditional=True
+    )
+
+
 @api.route('/import', methods=['POST'])
 @require_api_key
 def import_data():
@@ -840,13 +1231,26 @@ def import_data():
         - merge: Add new records, skip existing ones (based on card_number for users)
         - replace: Clear existing data and import new data
     
+    Rows are committed in batches, if the import fails part way the batches
+    already written stay imported and are reported in results.
+    
     Returns:
         JSON object with import results
     """
+    results = {
+        'users': {'added': 0, 'skipped': 0, 'errors': []},
+        'events': {'added': 0, 'skipped': 0, 'errors': []}
+    }
+    
     try:
-        request_data = request.get_json()
+        # Import bodies can be large, parse them straight from the stream
+        # without Flask keeping a second copy of the raw bytes
+        try:
+            request_data = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            request_data = None
         
-        if not request_data:
+        if not request_data or not isinstance(request_data, dict):
             return jsonify({
                 'success': False,
                 'error': 'Invalid request',
@@ -854,13 +1258,25 @@ def import_data():
             }), 400
         
         import_data = request_data.get('data')
-        if not import_data:
+        if not import_data or not isinstance(import_data, dict):
             return jsonify({
                 'success': False,
                 'error': 'Missing data',
                 'message': 'Request must include "data" field'
             }), 400
         
+        # Validate the shape once here so the import loops can index rows directly
+        shape_error = import_shape_error(import_data)
+        if shape_error:
+            return jsonify({
+                'success': False,
+                'error': 'Invalid data',
+                'message': shape_error
+            }), 400
+        
+        users_data = import_data.get('users', [])
+        events_data = import_data.get('events', [])
+        
         mode = request_data.get('mode', 'merge')
         skip_duplicates = request_data.get('skip_duplicates', True)
         
@@ -871,11 +1287,6 @@ def import_data():
                 'message': 'Mode must be "merge" or "replace"'
             }), 400
         
-        results = {
-            'users': {'added': 0, 'skipped': 0, 'errors': []},
-            'events': {'added': 0, 'skipped': 0, 'errors': []}
-        }
-        
         # Replace mode: clear existing data
         if mode == 'replace':
             try:
@@ -890,109 +1301,7 @@ def import_data():
                     'message': str(e)
                 }), 500
         
-        # Import users
-        users_data = import_data.get('users', [])
-        for user_data in users_data:
-            try:
-                # Check if user exists (by card_number)
-                existing_user = CardMemberMapping.query.filter_by(
-                    card_number=user_data.get('card_number')
-                ).first()
-                
-                if existing_user and skip_duplicates and mode == 'merge':
-                    results['users']['skipped'] += 1
-                    continue
-                
-                # Create new user (id will be auto-generated)
-                new_user = CardMemberMapping(
-                    card_number=user_data.get('card_number'),
-                    name=user_data.get('name'),
-                    email=user_data.get('email'),
-                    phone=user_data.get('phone'),
-                    login=user_data.get('login'),
-                    uid=user_data.get('uid'),
-                    note=user_data.get('note'),
-                    membership_type=user_data.get('membership_type')
-                )
-                
-                db.session.add(new_user)
-                results['users']['added'] += 1
-                
-            except Exception as e:
-                results['users']['errors'].append({
-                    'card_number': user_data.get('card_number'),
-                    'error': str(e)
-                })
-        
-        # Import events if provided
-        events_data = import_data.get('events', [])
-        for event_data in events_data:
-            try:
-                # Parse timestamp_utc if it's a string
-                timestamp_utc = None
-                if event_data.get('timestamp_utc'):
-                    timestamp_utc = datetime.datetime.fromisoformat(
-                        event_data['timestamp_utc'].replace('Z', '+00:00')
-                    )
-                
-                insert_timestamp_utc = None
-                if event_data.get('insert_timestamp_utc'):
-                    insert_timestamp_utc = datetime.datetime.fromisoformat(
-                        event_data['insert_timestamp_utc'].replace('Z', '+00:00')
-                    )
-                
-                # Check for duplicate events
-                if skip_duplicates and mode == 'merge':
-                    existing_event = GlobalEventLog.query.filter_by(
-                        controller_id=event_data.get('controller_id'),
-                        event_id=event_data.get('event_id'),
-                        timestamp=event_data.get('timestamp')
-                    ).first()
-                    
-                    if existing_event:
-                        results['events']['skipped'] += 1
-                        continue
-                
-                # Create new event (id will be auto-generated)
-                new_event = GlobalEventLog(
-                    controller_id=event_data.get('controller_id'),
-                    event_id=event_data.get('event_id'),
-                    timestamp=event_data.get('timestamp'),
-                    timestamp_utc=timestamp_utc,
-                    card_number=event_data.get('card_number'),
-                    event_type=event_data.get('event_type'),
-                    event_type_text=event_data.get('event_type_text'),
-                    access_granted=event_data.get('access_granted'),
-                    door_id=event_data.get('door_id'),
-                    direction=event_data.get('direction'),
-                    direction_text=event_data.get('direction_text'),
-                    event_reason=event_data.get('event_reason'),
-                    event_reason_text=event_data.get('event_reason_text'),
-                    insert_timestamp_utc=insert_timestamp_utc,
-                    name=event_data.get('name'),
-                    email=event_data.get('email'),
-                    membership_type=event_data.get('membership_type')
-                )
-                
-                db.session.add(new_event)
-                results['events']['added'] += 1
-                
-            except Exception as e:
-                results['events']['errors'].append({
-                    'event_id': event_data.get('event_id'),
-                    'error': str(e)
-                })
-        
-        # Commit all changes
-        try:
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            return jsonify({
-                'success': False,
-                'error': 'Failed to commit changes',
-                'message': str(e)
-            }), 500
+        import_rows(users_data, events_data, mode, skip_duplicates, results)
         
         return jsonify({
             'success': True,
@@ -1006,5 +1315,6 @@ def import_data():
         return jsonify({
             'success': False,
             'error': 'Import error',
-            'message': str(e)
+            'message': str(e),
+            'results': results
         }), 500
@@ -2,27 +2,119 @@
 # Author      : Jon Kelley <jon.kelley@kzoomakers.org>
 # Description : Kzoomakers Door Controller
 import requests
-from flask import Flask, render_template, request, flash, Blueprint, redirect, url_for, current_app, jsonify, send_file
+from flask import Flask, Response, render_template, request, flash, Blueprint, redirect, url_for, current_app, jsonify, stream_with_context
 import json
+import orjson
 import datetime  # Import the datetime module
-from doorctl.sharedlib.get_config import parse_uhppoted_config
+from collections import namedtuple
+from itertools import chain
+from urllib.parse import urlsplit, urlunsplit
+from doorctl.sharedlib.get_config import get_uhppoted_config
 from doorctl.sharedlib.cache import cache_manager
+from doorctl.sharedlib.http_session import session as http_session, fan_out, response_error, response_json, REQUEST_TIMEOUT
+from doorctl.sharedlib.json_stream import json_array
 import time
 from dateutil import tz
 import subprocess
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy import not_
+from sqlalchemy import bindparam, case, func, select, update
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from passlib.apache import HtpasswdFile
-from ..db import db, GlobalEventLog, CardMemberMapping, init_db
-import pytz
-import io
+from doorctl.blueprints.api import export_chunks, import_rows, import_shape_error
+from ..db import db, GlobalEventLog, CardMemberMapping, card_lookup, init_db, insert_unless_exists, upsert
 import os
 
 HEADERS = {'accept': 'application/json'}
 
+# card_lookup() values used for cards without a member
+UNKNOWN_MEMBER = ("Undefined", "Undefined", "Undefined", None)
+
+# A card on the show_cards page, number followed by its card_lookup() values
+CardRow = namedtuple('CardRow', 'number name email membership_type note')
+
+# Abbreviated day names accepted in the time profile weekdays field
+DAY_MAPPING = {
+    "Mon": "Monday",
+    "Tue": "Tuesday",
+    "Tues": "Tuesday",
+    "Wed": "Wednesday",
+    "Weds": "Wednesday",
+    "Thur": "Thursday",
+    "Thurs": "Thursday",
+    "Fri": "Friday",
+    "Sat": "Saturday",
+    "Sun": "Sunday"
+}
+
+
+# Member fields shown on the edit card form, selected without loading the ORM instance
+CARD_USER_FIELDS = ('name', 'email', 'phone', 'note', 'membership_type')
+CARD_USER_SELECT = select(*(getattr(CardMemberMapping, field) for field in CARD_USER_FIELDS)).where(
+    CardMemberMapping.card_number == bindparam('card_number'))
+
+
+def save_card_user(card_number, **fields):
+    """
+    Insert or update a card's member metadata (CARD_USER_FIELDS) in one statement and commit
+
+    Args:
+        card_number: Card number the metadata belongs to
+        **fields: Value for each of CARD_USER_FIELDS
+    """
+    stmt = upsert(CardMemberMapping, ['card_number'], CARD_USER_FIELDS)
+    db.session.execute(stmt.values(card_number=card_number, **fields))
+    db.session.commit()
+
+
+def append_card_note(card_number, line):
+    """
+    Append a line to a card's note (or set it if the note is blank) in one UPDATE and commit
+
+    Returns:
+        True if the card has member metadata to update
+    """
+    note = CardMemberMapping.note
+    stmt = (
+        update(CardMemberMapping)
+        .where(CardMemberMapping.card_number == card_number)
+        .values(note=case((func.trim(func.coalesce(note, '')) == '', line), else_=note + '\n' + line))
+        .execution_options(synchronize_session=False)
+    )
+    updated = db.session.execute(stmt).rowcount
+    db.session.commit()
+    return updated > 0
+
+# Door form values with their API values ('1' = Deny, '0' = Allow), anything else is a time profile ID
+DOOR_PERMISSIONS = {'1': 0, '0': 1}
+
+
+def door_permission(value):
+    """Convert a door form value to the value the controller API expects"""
+    permission = DOOR_PERMISSIONS.get(value)
+    return int(value) if permission is None else permission
+
+
+def expand_weekdays(weekdays):
+    """Expand a comma separated weekdays form value ("Mon, Wed") to full day names ("Monday,Wednesday")"""
+    return ",".join(DAY_MAPPING.get(day.strip(), day.strip()) for day in weekdays.replace(" ", "").split(","))
+
 doorctl = Blueprint('doorctl', __name__)
 
+# uhppoted REST endpoint, copied from the app config when the blueprint is registered
+# so URLs can be built without a context lookup (including on fan_out worker threads)
+REST_ENDPOINT = None
+
+
+@doorctl.record_once
+def load_rest_endpoint(state):
+    global REST_ENDPOINT
+    REST_ENDPOINT = state.app.config['REST_ENDPOINT']
+
+
+def device_url(device_id, *path):
+    """Build a controller URL, e.g. device_url(425036451, 'card', 10058400)"""
+    return '/'.join((REST_ENDPOINT, 'device', str(device_id), *map(str, path)))
+
 
 
 @doorctl.before_request
@@ -44,6 +136,66 @@ def run_on_all_routes():
             return 'Missing header x-doorcontrol-security-key'
 
 
+@doorctl.errorhandler(requests.exceptions.Timeout)
+def controller_timeout(e):
+    """
+    Handle a controller call that timed out and wasn't caught by the view
+    """
+    current_app.logger.warning("Controller request timed out: %s", e)
+    # Form posts go back to the page they came from with the error flashed.
+    # The Referer header is client-controlled, so only follow it on this host
+    if request.method == 'POST':
+        flash('The controller did not respond in time, please try again', 'danger')
+        return redirect(same_host_referrer() or url_for('doorctl.accesscontrol'))
+    return 'The controller did not respond in time', 504
+
+
+def same_host_referrer():
+    """Return the referrer's path (and query) when it points at this host, None otherwise"""
+    if not request.referrer:
+        return None
+    referrer = urlsplit(request.referrer)
+    if referrer.scheme not in ('http', 'https') or referrer.netloc != request.host:
+        return None
+    # Path only, so the redirect can never leave this host. Leading slashes are
+    # collapsed, '//other.host/' would otherwise be a scheme-relative URL
+    path = '/' + referrer.path.lstrip('/\\')
+    return urlunsplit(('', '', path, referrer.query, ''))
+
+
+
+def combine_global_cards(card_numbers, assigned_devices, globally_deactivated, card_data):
+    """
+    Build the globalcards table rows, split into (active, deactivated)
+
+    Args:
+        card_numbers: Unique card numbers found on the controllers
+        assigned_devices: {card_number: ["name (device_id)", ...]}
+        globally_deactivated: {card_number: True if denied on every controller}
+        card_data: card_lookup() result
+    """
+    cards = []
+    deactivated_cards = []
+    # Bound locally, this loop runs once per card on every page view
+    member_get = card_data.get
+    devices_get = assigned_devices.get
+    deactivated_get = globally_deactivated.get
+    for card_number in card_numbers:
+        name, email, membership_type, note = member_get(card_number, UNKNOWN_MEMBER)
+        card_info = {
+            "card_number": card_number,
+            "name": name,
+            "email": email,
+            "membership_type": membership_type,
+            "note": note,
+            "assigned_devices": devices_get(card_number, [])
+        }
+        if deactivated_get(card_number, False):
+            deactivated_cards.append(card_info)
+        else:
+            cards.append(card_info)
+    return cards, deactivated_cards
+
 
 @doorctl.route('/accesscontrol/global/cards')
 def globalcards():
@@ -53,106 +205,86 @@ def globalcards():
     
     if cached_global_data:
         current_app.logger.debug("Using cached global cards data")
-        # Still fetch fresh user metadata from database
-        db_allcards = CardMemberMapping.query.all()
-        card_data = {card.card_number: (card.name, card.email, card.membership_type, card.note)
-                     for card in db_allcards}
-        
-        # Merge cached controller data with fresh user data
-        cards = []
-        deactivated_cards = []
-        
-        for card_number in cached_global_data['all_cards_collapsed']:
-            assigned_device_list = cached_global_data['assigned_devices'].get(card_number, [])
-            name, email, membership_type, note = card_data.get(card_number,
-                                                         ("Undefined", "Undefined", "Undefined", None))
-            
-            # Check if card is deactivated (all doors set to deny across all controllers)
-            is_deactivated = cached_global_data.get('deactivated_cards', {}).get(card_number, False)
-            
-            card_info = {
-                "card_number": card_number,
-                "name": name,
-                "email": email,
-                "membership_type": membership_type,
-                "note": note,
-                "assigned_devices": assigned_device_list
-            }
-            
-            if is_deactivated:
-                deactivated_cards.append(card_info)
-            else:
-                cards.append(card_info)
-        
+        # Current user metadata (cached until the card table changes)
+        card_data = card_lookup()
+        
+        # Merge cached controller data with fresh user data. Cache entries are
+        # JSON, so the int card number keys come back as strings
+        assigned_devices = {int(card_number): devices
+                            for card_number, devices in cached_global_data['assigned_devices'].items()}
+        globally_deactivated = {int(card_number): deactivated
+                                for card_number, deactivated in cached_global_data.get('deactivated_cards', {}).items()}
+        cards, deactivated_cards = combine_global_cards(
+            cached_global_data['all_cards_collapsed'], assigned_devices, globally_deactivated, card_data)
+
         return render_template('globalcardusers.html', cards=cards, deactivated_cards=deactivated_cards)
     
     # Cache miss - fetch fresh data from all controllers
     current_app.logger.debug("Cache miss - fetching fresh global cards data")
-    url = f"{current_app.config['REST_ENDPOINT']}/device"
-    response = requests.get(url, headers=HEADERS)
 
-    all_cards = []
-    api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
-    device = {}
-    deactivated_status = {}  # Track deactivated status for each card
-    
-    for device_id, deviceproperty in api_config['devices'].items():
+    def fetch_cards_list(device_id):
         # Try individual controller cache first
         controller_cards_key = f"controller_{device_id}_cards_list"
         thecardslist = cache_manager.get(controller_cards_key)
-        
+
         if not thecardslist:
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/cards"
-            response = requests.get(url, headers=HEADERS)
+            url = device_url(device_id, 'cards')
+            response = http_session.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT)
             if response.status_code == 200:
-                thecardslist = response.json().get("cards")
+                thecardslist = response_json(response).get("cards") or []
                 cache_manager.set(controller_cards_key, thecardslist)
             else:
                 thecardslist = []
-        
-        device[device_id] = deviceproperty
-        device[device_id]['cards'] = thecardslist
-        all_cards.append(thecardslist)
-        
-        # Check deactivation status for each card on this controller
-        for card_number in thecardslist:
-            card_detail_key = f"controller_{device_id}_card_{card_number}"
-            card_details = cache_manager.get(card_detail_key)
-            
-            if not card_details:
-                card_url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/card/{card_number}"
-                card_response = requests.get(card_url)
-                if card_response.status_code == 200:
-                    card_details = card_response.json()['card']
-                    cache_manager.set(card_detail_key, card_details)
+        return thecardslist
+
+    def fetch_card_details(device_card):
+        device_id, card_number = device_card
+        card_detail_key = f"controller_{device_id}_card_{card_number}"
+        card_details = cache_manager.get(card_detail_key)
+
+        if not card_details:
+            card_url = device_url(device_id, 'card', card_number)
+            card_response = http_session.get(card_url, timeout=REQUEST_TIMEOUT)
+            if card_response.status_code == 200:
+                card_details = response_json(card_response)['card']
+                cache_manager.set(card_detail_key, card_details)
+        return card_details
+
+    api_config = get_uhppoted_config()
+    deactivated_status = {}  # Track deactivated status for each card
+
+    # Fetch every controller's card list concurrently. The lists are kept in a
+    # local dict, the config is shared between requests and must not be modified
+    device_cards = dict(fan_out(fetch_cards_list, api_config['devices'].keys()))
+
+    # Then the details of every card on every controller, also concurrently
+    card_pairs = [(device_id, card_number)
+                  for device_id, cards in device_cards.items()
+                  for card_number in cards]
+    for (device_id, card_number), card_details in fan_out(fetch_card_details, card_pairs):
+        # Check if deactivated on this controller
+        if card_details:
+            doors = card_details.get('doors', {})
+            # Check if all doors are set to 0 (deny) - API uses 0=deny, 1=allow
+            is_deactivated_on_controller = doors and all(value == 0 for value in doors.values())
             
-            # Check if deactivated on this controller
-            if card_details:
-                doors = card_details.get('doors', {})
-                # Check if all doors are set to 0 (deny) - API uses 0=deny, 1=allow
-                is_deactivated_on_controller = doors and all(value == 0 for value in doors.values())
-                
-                # Track deactivation status - card is only globally deactivated if deactivated on ALL controllers
-                if card_number not in deactivated_status:
-                    deactivated_status[card_number] = []
-                deactivated_status[card_number].append(is_deactivated_on_controller)
+            # Track deactivation status - card is only globally deactivated if deactivated on ALL controllers
+            if card_number not in deactivated_status:
+                deactivated_status[card_number] = []
+            deactivated_status[card_number].append(is_deactivated_on_controller)
     
-    all_cards_collapsed = []
-    for sublist in all_cards:
-        all_cards_collapsed.extend(sublist)
+    # Unique card numbers across all controllers (a card can be on several)
+    all_cards_set = set(chain.from_iterable(device_cards.values()))
 
-    current_app.logger.debug(f'all_cards_collapsed={all_cards_collapsed}')
-    # Initialize an empty dictionary to store assigned devices for each card
+    current_app.logger.debug('all_cards_set=%s', all_cards_set)
+    # Place the devices assigned to each card
     assigned_devices = {}
+    for device_id, cards in device_cards.items():
+        device_label = f"{api_config['devices'][device_id]['name']} ({device_id})"
+        for card_number in cards:
+            assigned_devices.setdefault(card_number, []).append(device_label)
 
-    # Iterate over the keys and values of your_dict and place the devices assigned to each card
-    for device_id, device_data in device.items():
-        for card_number in device_data['cards']:
-            if card_number not in assigned_devices:
-                assigned_devices[card_number] = []
-            assigned_devices[card_number].append(f"{device_data['name']} ({device_id})")
-
-    current_app.logger.debug(f'assigned_devices={assigned_devices}')
+    current_app.logger.debug('assigned_devices=%s', assigned_devices)
     
     # Determine which cards are globally deactivated (deactivated on ALL controllers)
     globally_deactivated = {}
@@ -162,39 +294,17 @@ def globalcards():
     
     # Cache the aggregated data
     global_cache_data = {
-        'all_cards_collapsed': all_cards_collapsed,
+        'all_cards_collapsed': list(all_cards_set),
         'assigned_devices': assigned_devices,
         'deactivated_cards': globally_deactivated
     }
     cache_manager.set(cache_key, global_cache_data)
     
-    # Continue with fresh user data from database
-    db_allcards = CardMemberMapping.query.all()
-    card_data = {card.card_number: (card.name, card.email, card.membership_type, card.note) for card in db_allcards}
-    current_app.logger.debug(f'card_data={card_data}')
+    # Continue with current user data (cached until the card table changes)
+    card_data = card_lookup()
+    current_app.logger.debug('card_data=%s', card_data)
     # Combine REST and database data to display in the table
-    # Use set() to get unique card numbers to prevent duplicates when a card is on multiple controllers
-    cards = []
-    deactivated_cards = []
-    
-    for card_number in set(all_cards_collapsed):
-        assigned_device_list = assigned_devices.get(card_number, [])
-        name, email, membership_type, note = card_data.get(card_number, ("Undefined", "Undefined", "Undefined", None))
-        
-        card_info = {
-            "card_number": card_number,
-            "name": name,
-            "email": email,
-            "membership_type": membership_type,
-            "note": note,
-            "assigned_devices": assigned_device_list
-        }
-        
-        # Check if globally deactivated
-        if globally_deactivated.get(card_number, False):
-            deactivated_cards.append(card_info)
-        else:
-            cards.append(card_info)
+    cards, deactivated_cards = combine_global_cards(all_cards_set, assigned_devices, globally_deactivated, card_data)
 
     return render_template('globalcardusers.html', cards=cards, deactivated_cards=deactivated_cards)
 
@@ -203,7 +313,7 @@ def globalcards():
 def api_get_controllers():
     """API endpoint to get list of controllers with device type info and time profiles"""
     try:
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
         controllers = []
         offline_controllers = []
         
@@ -238,8 +348,8 @@ def api_get_controllers():
                 else:
                     # Cache miss - fetch from API
                     current_app.logger.debug(f"Cache miss - fetching time profiles for controller {device_id}")
-                    url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/time-profiles"
-                    response = requests.get(url, timeout=3)
+                    url = device_url(device_id, 'time-profiles')
+                    response = http_session.get(url, timeout=3)
                     if response.status_code == 200:
                         time_profile_data = response.json()
                         time_profiles = time_profile_data.get('profiles', [])
@@ -323,18 +433,8 @@ def global_add_card():
         
         # Save global metadata to database
         try:
-            card_user = CardMemberMapping.query.filter_by(card_number=int(card_number)).one_or_none()
-            if card_user is None:
-                card_user = CardMemberMapping(card_number=int(card_number))
-            
-            card_user.name = name
-            card_user.email = email
-            card_user.phone = phone
-            card_user.note = note
-            card_user.membership_type = membership_type
-            
-            db.session.merge(card_user)
-            db.session.commit()
+            save_card_user(int(card_number), name=name, email=email, phone=phone, note=note,
+                           membership_type=membership_type)
         except Exception as e:
             db.session.rollback()
             flash(f'Error saving card metadata: {str(e)}', 'danger')
@@ -359,22 +459,14 @@ def global_add_card():
             while True:
                 door_key = f'door_{controller_id}_{door_num}'
                 if door_key in request.form:
-                    value = request.form.get(door_key)
-                    # Value mapping: '1' = Deny (API 0), '0' = Allow (API 1), other = Time Profile ID
-                    if value == '1':
-                        card_data['doors'][str(door_num)] = 0  # Deny
-                    elif value == '0':
-                        card_data['doors'][str(door_num)] = 1  # Allow
-                    else:
-                        # Time profile ID - pass through as integer
-                        card_data['doors'][str(door_num)] = int(value)
+                    card_data['doors'][str(door_num)] = door_permission(request.form.get(door_key))
                     door_num += 1
                 else:
                     break
             
             # Add card to this controller
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-            response = requests.put(url, json=card_data)
+            url = device_url(controller_id, 'card', card_number)
+            response = http_session.put(url, json=card_data)
             
             if response.status_code == 200:
                 success_count += 1
@@ -424,8 +516,8 @@ def global_delete_card_from_controllers():
                 controller_id = controller_info
             
             try:
-                url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-                response = requests.delete(url)
+                url = device_url(controller_id, 'card', card_number)
+                response = http_session.delete(url)
                 
                 if response.status_code == 200:
                     success_count += 1
@@ -479,8 +571,8 @@ def global_deactivate_card():
             
             try:
                 # First, get the current card data
-                url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-                response = requests.get(url)
+                url = device_url(controller_id, 'card', card_number)
+                response = http_session.get(url)
                 
                 if response.status_code == 200:
                     card_data = response.json()['card']
@@ -495,13 +587,14 @@ def global_deactivate_card():
                     }
                     
                     # Send a PUT request to update the card
-                    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-                    response = requests.put(url, json=card_data)
+                    url = device_url(controller_id, 'card', card_number)
+                    response = http_session.put(url, json=card_data)
                     
                     if response.status_code == 200:
                         success_count += 1
-                        # Invalidate cache for this controller
-                        cache_manager.invalidate(f"controller_{controller_id}_card_{card_number}")
+                        # The card now matches what was just written, so cache that instead of
+                        # leaving the card pages to GET it again
+                        cache_manager.set(f"controller_{controller_id}_card_{card_number}", card_data)
                     else:
                         failed_controllers.append(controller_id)
                 else:
@@ -518,19 +611,8 @@ def global_deactivate_card():
         # Update card note if reason was provided
         if reason and success_count > 0:
             try:
-                card_user = CardMemberMapping.query.filter_by(card_number=int(card_number)).one_or_none()
-                if card_user:
-                    # Get current timestamp
-                    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    deactivation_note = f"[DEACTIVATED {timestamp}] {reason}"
-                    
-                    # Append to existing note or create new note
-                    if card_user.note and card_user.note.strip():
-                        card_user.note = f"{card_user.note}\n{deactivation_note}"
-                    else:
-                        card_user.note = deactivation_note
-                    
-                    db.session.commit()
+                timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                if append_card_note(int(card_number), f"[DEACTIVATED {timestamp}] {reason}"):
                     current_app.logger.info(f"Updated note for card {card_number} with deactivation reason")
             except Exception as e:
                 current_app.logger.error(f"Error updating note for card {card_number}: {str(e)}")
@@ -554,36 +636,17 @@ def global_deactivate_card():
 
 @doorctl.route('/accesscontrol/global/cards/edit/<int:card_id>', methods=['GET', 'POST'])
 def globalcards_edit(card_id):
-    try:
-        card = CardMemberMapping.query.filter_by(card_number=card_id).one()
-    except NoResultFound:
-        card = CardMemberMapping(card_number=card_id)
-    
     if request.method == 'POST':
-        if card is None:
-            try:
-                # Attempt to retrieve an existing card by card_number
-                card = CardMemberMapping.query.filter_by(card_number=card_id).one()
-            except NoResultFound:
-                # If not found, create a new card
-                card = CardMemberMapping(card_number=card_id)
-
-        # Update global metadata
-        card.name = request.form['name']
-        card.email = request.form['email']
-        card.phone = request.form['phone']
-        card.note = request.form['note']
-        
         # Handle membership_type with "Other" option
         membership_type = request.form.get('membership_type', '')
         if membership_type == 'Other':
             membership_type = request.form.get('membership_type_other', '')
-        card.membership_type = membership_type
 
         try:
-            # Merge the card into the session to update or insert
-            db.session.merge(card)
-            db.session.commit()
+            # Update or insert the global metadata
+            save_card_user(card_id, name=request.form['name'], email=request.form['email'],
+                           phone=request.form['phone'], note=request.form['note'],
+                           membership_type=membership_type)
             flash('Global card metadata updated successfully', 'success')
         except Exception as e:
             # Handle other exceptions if necessary
@@ -592,7 +655,7 @@ def globalcards_edit(card_id):
             return redirect(url_for('doorctl.globalcards_edit', card_id=card_id))
         
         # Update controller-specific card data
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
         success_count = 0
         failed_controllers = []
         
@@ -625,19 +688,11 @@ def globalcards_edit(card_id):
                 for door_num in range(1, num_doors + 1):
                     door_key = f'door_{controller_id}_{door_num}'
                     if door_key in request.form:
-                        value = request.form.get(door_key)
-                        # Value mapping: '1' = Deny (API 0), '0' = Allow (API 1), other = Time Profile ID
-                        if value == '1':
-                            card_data['doors'][str(door_num)] = 0  # Deny
-                        elif value == '0':
-                            card_data['doors'][str(door_num)] = 1  # Allow
-                        else:
-                            # Time profile ID - pass through as integer
-                            card_data['doors'][str(door_num)] = int(value)
+                        card_data['doors'][str(door_num)] = door_permission(request.form.get(door_key))
                 
                 # Update card on this controller
-                url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_id}"
-                response = requests.put(url, json=card_data)
+                url = device_url(controller_id, 'card', card_id)
+                response = http_session.put(url, json=card_data)
                 
                 if response.status_code == 200:
                     success_count += 1
@@ -659,8 +714,13 @@ def globalcards_edit(card_id):
 
         return redirect(url_for('doorctl.globalcards_edit', card_id=card_id))
 
+    try:
+        card = CardMemberMapping.query.filter_by(card_number=card_id).one()
+    except NoResultFound:
+        card = CardMemberMapping(card_number=card_id)
+
     # GET request - fetch controller data and card data from each controller
-    api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+    api_config = get_uhppoted_config()
     controllers = []
     offline_controllers = []
     
@@ -683,8 +743,8 @@ def globalcards_edit(card_id):
         # Try to fetch existing card data from this controller
         card_data = None
         try:
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_id}"
-            response = requests.get(url, timeout=3)
+            url = device_url(controller_id, 'card', card_id)
+            response = http_session.get(url, timeout=3)
             current_app.logger.debug(f'Card fetch for controller {controller_id}: status={response.status_code}, url={url}')
             if response.status_code == 200:
                 card_data = response.json().get('card', {})
@@ -697,11 +757,7 @@ def globalcards_edit(card_id):
                 current_app.logger.debug(f'Controller {controller_id} card not found (404) but controller is online')
             elif response.status_code == 500:
                 # 500 error - log the error message but controller might still be online
-                try:
-                    error_msg = response.json().get('message', 'Unknown error')
-                    current_app.logger.warning(f'Controller {controller_id} returned 500 error for card {card_id}: {error_msg}')
-                except:
-                    current_app.logger.warning(f'Controller {controller_id} returned 500 error for card {card_id}: {response.text}')
+                current_app.logger.warning(f'Controller {controller_id} returned 500 error for card {card_id}: {response_error(response)}')
                 # Treat 500 as controller being online but card not existing/having issues
                 card_data = None
                 card_fetch_succeeded = True
@@ -715,23 +771,11 @@ def globalcards_edit(card_id):
             controller_online = False
             current_app.logger.warning(f'Failed to fetch card {card_id} from controller {controller_id}: {str(e)}')
         
-        # Fetch time profiles for this controller with caching
+        # Fetch time profiles for this controller (cached)
         time_profiles = []
         try:
-            # Check cache first (30 min TTL)
-            time_profile_key = f"controller_{controller_id}_time_profiles"
-            cached_profiles = cache_manager.get(time_profile_key)
-            
-            if cached_profiles:
-                current_app.logger.debug(f"Using cached time profiles for controller {controller_id}")
-                time_profiles = cached_profiles.get('profiles', [])
-            else:
-                # Cache miss - fetch from API
-                current_app.logger.debug(f"Cache miss - fetching time profiles for controller {controller_id}")
-                time_profile_data = get_time_profiles(controller_id)
-                time_profiles = time_profile_data.get('profiles', []) if time_profile_data else []
-                if time_profile_data:
-                    cache_manager.set(time_profile_key, time_profile_data)
+            time_profile_data = cached_time_profiles(controller_id)
+            time_profiles = time_profile_data.get('profiles', []) if time_profile_data else []
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
             # Only mark offline if we haven't already confirmed the controller is online via card fetch
             if not card_fetch_succeeded:
@@ -790,7 +834,7 @@ def globalcards_edit(card_id):
 
 @doorctl.route('/accesscontrol/edit/<int:card_id>', methods=['GET', 'POST'])
 def edit_card(card_id):
-    card = CardMemberMapping.query.get(card_id)
+    card = db.session.get(CardMemberMapping, card_id)
     if request.method == 'POST':
         card.name = request.form['name']
         card.email = request.form['email']
@@ -853,16 +897,16 @@ def cache_warmup():
         current_app.logger.info("Starting comprehensive cache warm-up")
         
         # Get API config once
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
         
         # Warm up controllers list
         cache_key = "controllers_list"
         if not cache_manager.get(cache_key):
             current_app.logger.debug("Warming up controllers list cache")
-            url = f"{current_app.config['REST_ENDPOINT']}/device"
-            response = requests.get(url, headers=HEADERS)
+            url = f"{REST_ENDPOINT}/device"
+            response = http_session.get(url, headers=HEADERS)
             if response.status_code == 200:
-                data = response.json()
+                data = response_json(response)
                 for device in data['devices']:
                     device_id = device['device-id']
                     if str(device_id) in api_config['devices']:
@@ -877,10 +921,10 @@ def cache_warmup():
             thecardslist = cache_manager.get(controller_cards_key)
             if not thecardslist:
                 current_app.logger.debug(f"Warming up card list cache for controller {device_id}")
-                url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/cards"
-                response = requests.get(url, headers=HEADERS)
+                url = device_url(device_id, 'cards')
+                response = http_session.get(url, headers=HEADERS)
                 if response.status_code == 200:
-                    thecardslist = response.json().get("cards", [])
+                    thecardslist = response_json(response).get("cards", [])
                     cache_manager.set(controller_cards_key, thecardslist)
                     current_app.logger.info(f"Card list cache warmed up for controller {device_id}")
                 else:
@@ -892,20 +936,20 @@ def cache_warmup():
                     card_detail_key = f"controller_{device_id}_card_{card_number}"
                     if not cache_manager.get(card_detail_key):
                         current_app.logger.debug(f"Warming up card {card_number} details for controller {device_id}")
-                        card_url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/card/{card_number}"
-                        card_response = requests.get(card_url)
+                        card_url = device_url(device_id, 'card', card_number)
+                        card_response = http_session.get(card_url)
                         if card_response.status_code == 200:
-                            card_details = card_response.json()['card']
+                            card_details = response_json(card_response)['card']
                             cache_manager.set(card_detail_key, card_details)
             
             # Warm up time profiles for this controller
             time_profile_key = f"controller_{device_id}_time_profiles"
             if not cache_manager.get(time_profile_key):
                 current_app.logger.debug(f"Warming up time profiles cache for controller {device_id}")
-                url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/time-profiles"
-                response = requests.get(url)
+                url = device_url(device_id, 'time-profiles')
+                response = http_session.get(url)
                 if response.status_code == 200:
-                    time_profiles_data = response.json()
+                    time_profiles_data = response_json(response)
                     cache_manager.set(time_profile_key, time_profiles_data)
                     current_app.logger.info(f"Time profiles cache warmed up for controller {device_id}")
             
@@ -913,10 +957,10 @@ def cache_warmup():
             door_states_key = f"controller_{device_id}_door_states"
             if not cache_manager.get(door_states_key, ttl=300):
                 current_app.logger.debug(f"Warming up door states cache for controller {device_id}")
-                url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/status"
-                response = requests.get(url)
+                url = device_url(device_id, 'status')
+                response = http_session.get(url)
                 if response.status_code == 200:
-                    status_data = response.json()
+                    status_data = response_json(response)
                     door_states = status_data.get('status', {}).get('door-states', {})
                     cache_manager.set(door_states_key, door_states, ttl=300)
                     current_app.logger.info(f"Door states cache warmed up for controller {device_id}")
@@ -925,34 +969,24 @@ def cache_warmup():
         cache_key = "global_cards_aggregated"
         if not cache_manager.get(cache_key):
             current_app.logger.debug("Warming up global cards aggregated cache")
-            device = {}
-            all_cards = []
+            device_cards = {}
             
-            for device_id, deviceproperty in api_config['devices'].items():
+            for device_id in api_config['devices']:
                 # Use already cached card lists
                 controller_cards_key = f"controller_{device_id}_cards_list"
-                thecardslist = cache_manager.get(controller_cards_key)
-                if not thecardslist:
-                    thecardslist = []
-                
-                device[device_id] = deviceproperty
-                device[device_id]['cards'] = thecardslist
-                all_cards.append(thecardslist)
+                device_cards[device_id] = cache_manager.get(controller_cards_key) or []
             
-            # Collapse and aggregate
-            all_cards_collapsed = []
-            for sublist in all_cards:
-                all_cards_collapsed.extend(sublist)
+            # Collapse (unique card numbers) and aggregate
+            all_cards_set = set(chain.from_iterable(device_cards.values()))
             
             assigned_devices = {}
-            for device_id, device_data in device.items():
-                for card_number in device_data['cards']:
-                    if card_number not in assigned_devices:
-                        assigned_devices[card_number] = []
-                    assigned_devices[card_number].append(f"{device_data['name']} ({device_id})")
+            for device_id, cards in device_cards.items():
+                device_label = f"{api_config['devices'][device_id]['name']} ({device_id})"
+                for card_number in cards:
+                    assigned_devices.setdefault(card_number, []).append(device_label)
             
             global_cache_data = {
-                'all_cards_collapsed': all_cards_collapsed,
+                'all_cards_collapsed': list(all_cards_set),
                 'assigned_devices': assigned_devices
             }
             cache_manager.set(cache_key, global_cache_data)
@@ -980,13 +1014,13 @@ def controllers_list():
     
     # Cache miss - fetch fresh data
     current_app.logger.debug("Cache miss - fetching fresh controllers list")
-    url = f"{current_app.config['REST_ENDPOINT']}/device"
-    response = requests.get(url, headers=HEADERS)
+    url = f"{REST_ENDPOINT}/device"
+    response = http_session.get(url, headers=HEADERS)
 
-    api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+    api_config = get_uhppoted_config()
     print(api_config)
     if response.status_code == 200:
-        data = response.json()
+        data = response_json(response)
         for device in data['devices']:
             device_id = device['device-id']
 
@@ -1009,14 +1043,14 @@ def controllers_list():
 def swipe_card(controller_id, door):
     card_number = request.json.get('card-number')
     try:
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/door/{door}/swipes"
-        response = requests.post(url, json={"card-number": int(card_number)})
+        url = device_url(controller_id, 'door', door, 'swipes')
+        response = http_session.post(url, json={"card-number": int(card_number)})
         if response.status_code in [401, 404, 405, 500]:
-            error_data = response.json()
             # Flashing the error for the JS to pick up
-            #flash(error_data.get('message'), 'error')
-            return json.dumps({"error": "API error", "message": error_data.get('message')}), 500
-        return json.dumps(response.json())
+            #flash(response_error(response), 'error')
+            return json.dumps({"error": "API error", "message": response_error(response, None)}), 500
+        # Pass the controller's JSON straight through
+        return Response(response.content, status=response.status_code, mimetype='application/json')
     except requests.RequestException as e:
             return json.dumps({"error": "API error"}), 500
     except Exception as e:
@@ -1028,11 +1062,12 @@ def set_door_delay(controller_id, door):
     try:
         payload = {"delay": int(delay_time)}
 
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/door/{door}/delay"
-        response = requests.put(url, json=payload)
+        url = device_url(controller_id, 'door', door, 'delay')
+        response = http_session.put(url, json=payload)
         #response = requests.put(REMOTE_API_DELAY_URL.format(device_id, door), json={"delay": delay_time})
         response.raise_for_status()
-        return json.dumps(response.json())
+        # Pass the controller's JSON straight through
+        return Response(response.content, status=response.status_code, mimetype='application/json')
     except requests.RequestException as e:
         # Flashing the error for the JS to pick up
         #flash(str(e), 'error')
@@ -1042,10 +1077,11 @@ def set_door_delay(controller_id, door):
 def set_door_control(controller_id, door):
     control_state = request.json.get('control')
     try:
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/door/{door}/control"
-        response = requests.put(url, json={"control": control_state})
+        url = device_url(controller_id, 'door', door, 'control')
+        response = http_session.put(url, json={"control": control_state})
         response.raise_for_status()
-        return json.dumps(response.json())
+        # Pass the controller's JSON straight through
+        return Response(response.content, status=response.status_code, mimetype='application/json')
     except requests.RequestException as e:
         # Flashing the error for the JS to pick up
         #flash(str(e), 'error')
@@ -1056,21 +1092,23 @@ def set_door_control(controller_id, door):
 def manage_doors(controller_id):
 
     # Fetch device status
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/status"
-    response = requests.get(url)
+    url = device_url(controller_id, 'status')
+    response = http_session.get(url)
     if response.status_code == 200:
-        device_status = response.json()
+        device_status = response_json(response)
     else:
         device_status = {}
         flash(f"Failed to retrieve device status. Status code: {response.status_code}", "danger")
 
-    # Fetch door details for each door
+    # Fetch door details for each door, concurrently
+    def fetch_door(door_id):
+        url = device_url(controller_id, 'door', door_id)
+        return http_session.get(url, timeout=REQUEST_TIMEOUT)
+
     door_info = {}
-    for door_id in device_status.get('status', {}).get('door-states', {}):
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/door/{door_id}"
-        response = requests.get(url)
+    for door_id, response in fan_out(fetch_door, device_status.get('status', {}).get('door-states', {})):
         if response.status_code == 200:
-            door_info[door_id] = response.json().get('door', {})
+            door_info[door_id] = response_json(response).get('door', {})
         else:
             flash(f"Failed to retrieve door {door_id} details. Status code: {response.status_code}", "danger")
 
@@ -1079,20 +1117,21 @@ def manage_doors(controller_id):
 ##### device info #####
 @doorctl.route('/accesscontrol/controller/<int:controller_id>/info')
 def display_device_info(controller_id):
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/status"
-    response = requests.get(url)
-    if response.status_code == 200:
-        device_status = response.json()
+    # Fetch the status and the device details concurrently
+    (_, status_response), (_, info_response) = fan_out(
+        lambda url: http_session.get(url, timeout=REQUEST_TIMEOUT),
+        (device_url(controller_id, 'status'), device_url(controller_id))
+    )
+    if status_response.status_code == 200:
+        device_status = response_json(status_response)
     else:
         device_status = {}
-        flash(f"Failed to retrieve device status. Status code: {response.status_code}", "danger")
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}"
-    response = requests.get(url)
-    if response.status_code == 200:
-        device_info = response.json()
+        flash(f"Failed to retrieve device status. Status code: {status_response.status_code}", "danger")
+    if info_response.status_code == 200:
+        device_info = response_json(info_response)
     else:
         device_info = {}
-        flash(f"Failed to retrieve device status. Status code: {response.status_code}", "danger")
+        flash(f"Failed to retrieve device status. Status code: {info_response.status_code}", "danger")
     return render_template('controller_info.html', controller_id=controller_id, device_status=device_status, device_info=device_info)
 
 
@@ -1101,6 +1140,44 @@ def display_device_info(controller_id):
 
 ##### events #####
 
+def fetch_event_range(device_id, first, last):
+    """
+    Fetch events first..last (inclusive) from a controller, newest first
+
+    uhppoted-rest has no bulk range endpoint, so the individual event GETs
+    are fanned out and collected here; callers only deal with the list.
+
+    Args:
+        device_id: The device ID to get events for
+        first: Oldest event ID to fetch
+        last: Newest event ID to fetch
+
+    Returns:
+        List of event dicts, ordered from last down to first
+    """
+    def fetch_event(event_id):
+        url = device_url(device_id, 'event', event_id)
+        response = http_session.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+        return response_json(response)['event']
+
+    return [event for _, event in fan_out(fetch_event, range(last, first - 1, -1))]
+
+
+def pagination_info(page, per_page, total):
+    """Pagination metadata for a page of a listing with total entries"""
+    total_pages = (total + per_page - 1) // per_page  # Ceiling division
+    return {
+        "page": page,
+        "per_page": per_page,
+        "total": total,
+        "total_pages": total_pages,
+        "has_prev": page > 1,
+        "has_next": page < total_pages,
+        "prev_page": page - 1 if page > 1 else None,
+        "next_page": page + 1 if page < total_pages else None
+    }
+
+
 def get_events(device_id, page=1, per_page=50):
     """
     Get events with pagination support
@@ -1111,18 +1188,15 @@ def get_events(device_id, page=1, per_page=50):
         per_page: Number of events per page
     """
     # Get range of events
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/events/1000"
+    url = device_url(device_id, 'events', '1000')
     print(f'getting events list {url}')
-    response = requests.get(url, headers={'accept': 'application/json'})
-    response_data = response.json()
+    response = http_session.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT)
+    response_data = response_json(response)
 
     first_event = response_data['events']['first']
     last_event = response_data['events']['last']
     total_events = last_event - first_event + 1
 
-    # Calculate pagination
-    total_pages = (total_events + per_page - 1) // per_page  # Ceiling division
-    
     # Calculate which events to fetch for this page
     start_index = (page - 1) * per_page
     end_index = min(start_index + per_page, total_events)
@@ -1132,130 +1206,166 @@ def get_events(device_id, page=1, per_page=50):
     end_event_id = last_event - end_index + 1
 
     events = []
-    db_cards = CardMemberMapping.query.all()
-    card_data = {card.card_number: (card.name, card.email, card.membership_type) for card in db_cards}
+    card_data = card_lookup()
     
-    # Fetch only the events for this page
-    for i in range(start_event_id, end_event_id - 1, -1):
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{device_id}/event/{i}"
-        response = requests.get(url, headers={'accept': 'application/json'})
-        event_data = response.json()
-
-        name, email, membership_type = card_data.get(event_data["event"]["card-number"], ("Undefined", "Undefined", "Undefined"))
+    # Fetch only the events for this page (newest first)
+    for event in fetch_event_range(device_id, end_event_id, start_event_id):
+        name, email, membership_type, _ = card_data.get(event["card-number"], UNKNOWN_MEMBER)
         event_dict = {
-            "device-id": event_data["event"]["device-id"],
+            "device-id": event["device-id"],
             "name": name,
             "email": email,
             "membership-type": membership_type,
-            "event-id": event_data["event"]["event-id"],
-            "event-type": event_data["event"]["event-type"],
-            "event-type-text": event_data["event"]["event-type-text"],
-            "access-granted": event_data["event"]["access-granted"],
-            "door-id": event_data["event"]["door-id"],
-            "direction": event_data["event"]["direction"],
-            "direction-text": event_data["event"]["direction-text"],
-            "card-number": event_data["event"]["card-number"],
-            "timestamp": event_data["event"]["timestamp"],
-            "event-reason": event_data["event"]["event-reason"],
-            "event-reason-text": event_data["event"]["event-reason-text"]
+            "event-id": event["event-id"],
+            "event-type": event["event-type"],
+            "event-type-text": event["event-type-text"],
+            "access-granted": event["access-granted"],
+            "door-id": event["door-id"],
+            "direction": event["direction"],
+            "direction-text": event["direction-text"],
+            "card-number": event["card-number"],
+            "timestamp": event["timestamp"],
+            "event-reason": event["event-reason"],
+            "event-reason-text": event["event-reason-text"]
         }
         events.append(event_dict)
 
     return {
         "events": events,
-        "pagination": {
-            "page": page,
-            "per_page": per_page,
-            "total": total_events,
-            "total_pages": total_pages,
-            "has_prev": page > 1,
-            "has_next": page < total_pages,
-            "prev_page": page - 1 if page > 1 else None,
-            "next_page": page + 1 if page < total_pages else None
-        }
+        "pagination": pagination_info(page, per_page, total_events)
     }
 
+
+# Event log fields returned by the get_events_in_log endpoints, in response order
+EVENT_LOG_FIELDS = (
+    'controller_id', 'insert_timestamp_utc', 'event_id', 'timestamp_utc', 'timestamp',
+    'card_number', 'event_type', 'event_type_text', 'access_granted', 'door_id',
+    'direction', 'direction_text', 'event_reason', 'event_reason_text', 'name',
+    'email', 'membership_type'
+)
+EVENT_LOG_COLUMNS = [getattr(GlobalEventLog, field) for field in EVENT_LOG_FIELDS]
+
+
+def event_log_response(*criteria):
+    """
+    Stream the stored events matching criteria as {"events": [...]}
+
+    Only the listed columns are selected and rows are fetched and encoded in
+    batches, so memory use does not grow with the size of the log. When the
+    request has page/per_page arguments only that page is returned, along
+    with the same "pagination" object as get_events()
+    """
+    # Most recent first, like the API listing, so page 1 holds the newest events
+    # and the ORDER BY is served by the ix_events_* indexes
+    stmt = (select(*EVENT_LOG_COLUMNS)
+            .where(*criteria)
+            .order_by(GlobalEventLog.timestamp_utc.desc(), GlobalEventLog.id.desc())
+            .execution_options(yield_per=1000))
+
+    pagination = None
+    if 'page' in request.args or 'per_page' in request.args:
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 10000)
+        total = db.session.execute(
+            select(func.count()).select_from(GlobalEventLog).where(*criteria)
+        ).scalar_one()
+        pagination = pagination_info(page, per_page, total)
+        stmt = stmt.limit(per_page).offset((page - 1) * per_page)
+
+    result = db.session.execute(stmt)
+
+    def generate():
+        yield b'{"events":'
+        yield from json_array(dict(row._mapping) for row in result)
+        if pagination is not None:
+            yield b',"pagination":' + orjson.dumps(pagination)
+        yield b'}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
 @doorctl.route('/accesscontrol/get_events_in_log_by_doors/controller/<int:controller_id>/doors/<string:door_ids>', methods=['GET'])
 def get_events_in_log_by_doors(controller_id, door_ids):
     door_ids = door_ids.split(',')
     door_ids = [int(door_id) for door_id in door_ids]
     try:
-        events = GlobalEventLog.query.all()
-        events_data = []
-
-        for event in events:
-            if (event.controller_id == controller_id) and (event.door_id in door_ids):
-                event_dict = {
-                    "controller_id": event.controller_id,
-                    "insert_timestamp_utc": event.insert_timestamp_utc,
-                    "event_id": event.event_id,
-                    "timestamp_utc": event.timestamp_utc,
-                    "timestamp": event.timestamp,
-                    "card_number": event.card_number,
-                    "event_type": event.event_type,
-                    "event_type_text": event.event_type_text,
-                    "access_granted": event.access_granted,
-                    "door_id": event.door_id,
-                    "direction": event.direction,
-                    "direction_text": event.direction_text,
-                    "event_reason": event.event_reason,
-                    "event_reason_text": event.event_reason_text,
-                    "name": event.name,
-                    "email": event.email,
-                    "membership_type": event.membership_type,
-                }
-                events_data.append(event_dict)
-
-
-        return jsonify(events=events_data)
+        return event_log_response(
+            GlobalEventLog.controller_id == controller_id,
+            GlobalEventLog.door_id.in_(door_ids)
+        )
     except Exception as e:
         return jsonify(message=f'Error: {str(e)}'), 500
 
 
 
+# Columns compared when deciding whether a controller event is already stored,
+# paired with the matching key in the get_events() event dicts
+EVENT_LOG_KEYS = (
+    ('event_id', 'event-id'),
+    ('timestamp', 'timestamp'),
+    ('card_number', 'card-number'),
+    ('event_type', 'event-type'),
+    ('event_type_text', 'event-type-text'),
+    ('access_granted', 'access-granted'),
+    ('door_id', 'door-id'),
+    ('direction', 'direction'),
+    ('direction_text', 'direction-text'),
+    ('event_reason', 'event-reason'),
+    ('event_reason_text', 'event-reason-text'),
+)
+
+# Skips events already stored for the controller, so the database does the
+# duplicate check (no unique index, older logs may already hold duplicates)
+EVENT_LOG_INSERT = insert_unless_exists(GlobalEventLog, ('controller_id',) + tuple(column for column, _ in EVENT_LOG_KEYS))
+
+
+def controller_timestamp_to_utc(timestamp):
+    """
+    Convert a controller event timestamp ('2024-05-01 10:00:00 EDT') to UTC
+
+    The zone is an abbreviation, not a zoneinfo key, so it can't be looked up:
+
+    - 'UTC' and 'GMT' stamps are taken as UTC
+    - any other zone must be one of this host's local zone names
+      (time.tzname, matched case-sensitively) and the time is read as local
+      time; the abbreviation itself does not pick the offset
+    - anything else raises ValueError
+
+    This differs from the old strptime('%Z') + astimezone(pytz.utc) code,
+    which read UTC/GMT stamps as local time too and matched names
+    case-insensitively
+    """
+    date_part, _, tz_name = timestamp.rpartition(' ')
+    source_datetime = datetime.datetime.fromisoformat(date_part)
+    if tz_name in ('UTC', 'GMT'):
+        return source_datetime.replace(tzinfo=datetime.timezone.utc)
+    if tz_name not in time.tzname:
+        raise ValueError(f"time data '{timestamp}' has an unknown timezone '{tz_name}'")
+    return source_datetime.astimezone(datetime.timezone.utc)
+
+
 @doorctl.route('/accesscontrol/store_events_in_log', methods=['GET'])
 def store_events_in_log():
-    api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+    api_config = get_uhppoted_config()
     device = {}
-    db_cards = CardMemberMapping.query.all()
-    card_data = {card.card_number: (card.name, card.email, card.membership_type) for card in db_cards}
+    card_data = card_lookup()
     for controller_id, deviceproperty in api_config['devices'].items():
         try:
             events_data = get_events(controller_id)
 
             event_count=0
-            event_dupe_count=0
+            new_events = []
             for event_dict in events_data['events']:
-                name, email, membership_type = card_data.get(event_dict.get("card-number"), ("Undefined", "Undefined", "Undefined"))
+                name, email, membership_type, _ = card_data.get(event_dict.get("card-number"), UNKNOWN_MEMBER)
                 event_count += 1
-                print(event_dict)
-                # Check if an identical entry already exists in the database
-                existing_entry = GlobalEventLog.query.filter_by(
-                    controller_id=controller_id,
-                    event_id=event_dict.get("event-id"),
-                    timestamp=event_dict.get("timestamp"),
-                    card_number=event_dict.get("card-number"),
-                    event_type=event_dict.get("event-type"),
-                    event_type_text=event_dict.get("event-type-text"),
-                    access_granted=event_dict.get("access-granted"),
-                    door_id=event_dict.get("door-id"),
-                    direction=event_dict.get("direction"),
-                    direction_text=event_dict.get("direction-text"),
-                    event_reason=event_dict.get("event-reason"),
-                    event_reason_text=event_dict.get("event-reason-text")
-                ).first()
-                print(f'entry={existing_entry}')
-
-                if not existing_entry and (name != "Undefined"):
+
+                # Events of unknown cards are ignored, stored ones are skipped by the INSERT
+                if name != "Undefined":
                     source_timestamp = event_dict.get("timestamp", "")
-                    current_app.logger.warning(f'source_timestamp={source_timestamp}')
-                    source_datetime = datetime.datetime.strptime(source_timestamp, "%Y-%m-%d %H:%M:%S %Z")
-                    current_app.logger.warning(f'source_datetime={source_datetime}')
-                    source_datetime_utc = source_datetime.astimezone(pytz.utc)
-                    current_app.logger.warning(f'source_datetime_utc={source_datetime_utc}')
-
-                    new_event = GlobalEventLog(
-                        controller_id=controller_id,
+                    source_datetime_utc = controller_timestamp_to_utc(source_timestamp)
+
+                    new_events.append(dict(
+                        controller_id=int(controller_id),
                         event_id=event_dict.get("event-id", 0),
                         timestamp=event_dict.get("timestamp", ""),
                         timestamp_utc=source_datetime_utc,
@@ -1268,17 +1378,16 @@ def store_events_in_log():
                         direction_text=event_dict.get("direction-text", ""),
                         event_reason=event_dict.get("event-reason", 0),
                         event_reason_text=event_dict.get("event-reason-text", ""),
+                        insert_timestamp_utc=None,
                         name=event_dict.get("name", ""),
                         email=event_dict.get("email", ""),
                         membership_type=event_dict.get("membership_type", "")
-                    )
-
-                    db.session.add(new_event)
-                else:
-                    event_dupe_count += 1
-                    current_app.logger.warning(f'store_events_in_log : ignoring existing entry from controller: {controller_id} event-id: {event_dict["event-id"]} timestamp: {event_dict["timestamp"]}')
+                    ))
 
+            # Single executemany INSERT ... WHERE NOT EXISTS for all candidate events
+            added = db.session.execute(EVENT_LOG_INSERT, new_events).rowcount if new_events else 0
             db.session.commit()
+            event_dupe_count = event_count - added
             return jsonify(message=f'Events stored successfully, {event_dupe_count} out of {event_count} events were ignored duplicates.'), 201
         except Exception as e:
             return jsonify(message=f'Error: {str(e)}'), 500
@@ -1287,32 +1396,7 @@ def store_events_in_log():
 @doorctl.route('/accesscontrol/get_events_in_log', methods=['GET'])
 def get_events_in_log():
     try:
-        events = GlobalEventLog.query.all()
-        events_data = []
-
-        for event in events:
-            event_dict = {
-                "controller_id": event.controller_id,
-                "insert_timestamp_utc": event.insert_timestamp_utc,
-                "event_id": event.event_id,
-                "timestamp_utc": event.timestamp_utc,
-                "timestamp": event.timestamp,
-                "card_number": event.card_number,
-                "event_type": event.event_type,
-                "event_type_text": event.event_type_text,
-                "access_granted": event.access_granted,
-                "door_id": event.door_id,
-                "direction": event.direction,
-                "direction_text": event.direction_text,
-                "event_reason": event.event_reason,
-                "event_reason_text": event.event_reason_text,
-                "name": event.name,
-                "email": event.email,
-                "membership_type": event.membership_type,
-            }
-            events_data.append(event_dict)
-
-        return jsonify(events=events_data)
+        return event_log_response()
     except Exception as e:
         return jsonify(message=f'Error: {str(e)}'), 500
 
@@ -1331,11 +1415,43 @@ def device_events(controller_id):
 
 
 ##### time profiles #####
+
+# Assignable time profile IDs (1 is reserved)
+PROFILE_IDS = frozenset(range(2, 255))
+
+# Profiles carry three segments, the form only sets the first
+EMPTY_SEGMENT = {'start': '00:00', 'end': '00:00'}
+UNUSED_SEGMENTS = (EMPTY_SEGMENT, EMPTY_SEGMENT)
+
+# Deleting a profile overwrites it with this one, a past date range and minimal
+# weekdays effectively disable it (weekdays is required and cannot be empty)
+DISABLED_TIME_PROFILE = {
+    "start-date": "2000-01-01",
+    "end-date": "2000-01-02",
+    "weekdays": "Monday",
+    "segments": [EMPTY_SEGMENT]
+}
+
+
+def put_time_profile(controller_ids, profile_id, time_profile_data):
+    """
+    PUT a time profile to several controllers concurrently
+
+    Returns:
+        List of (controller_id, response) tuples in the order given
+    """
+    def put_profile(ctrl_id):
+        url = device_url(ctrl_id, 'time-profile', profile_id)
+        return http_session.put(url, json=time_profile_data)
+
+    return fan_out(put_profile, controller_ids)
+
+
 @doorctl.route("/accesscontrol/controller//<int:controller_id>/add_time_profile", methods=["GET", "POST"])
 def add_time_profile(controller_id):
     if request.method == "GET":
         # Get all controllers from config
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
         controllers = []
         for ctrl_id, ctrl_info in api_config['devices'].items():
             controllers.append({
@@ -1344,13 +1460,14 @@ def add_time_profile(controller_id):
             })
         
         # Get existing time profiles to find the next available ID
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time-profiles"
-        response = requests.get(url)
+        url = device_url(controller_id, 'time-profiles')
+        response = http_session.get(url)
         
         next_profile_id = 2  # Start from 2 (1 is reserved)
         if response.status_code == 200:
             time_profiles_data = response.json()
             existing_ids = set()
+            today = datetime.date.today()
             
             # Collect all existing profile IDs that are actually in use
             # (not expired or with empty time segments)
@@ -1361,47 +1478,25 @@ def add_time_profile(controller_id):
                     end_date_str = profile.get('end-date', '')
                     if end_date_str:
                         try:
-                            end_date = datetime.datetime.strptime(end_date_str, '%Y-%m-%d').date()
-                            if end_date >= datetime.date.today():
+                            end_date = datetime.date.fromisoformat(end_date_str)
+                            if end_date >= today:
                                 existing_ids.add(profile['id'])
                         except:
                             existing_ids.add(profile['id'])
             
             # Find the next available ID
-            for i in range(2, 255):  # Profile IDs are 2-254
-                if i not in existing_ids:
-                    next_profile_id = i
-                    break
-            else:
+            free_ids = PROFILE_IDS - existing_ids
+            if not free_ids:
                 # All IDs are taken
                 flash("Maximum number of time profiles reached (254). Please delete an existing profile first.", "danger")
                 return redirect(url_for("doorctl.get_time_profiles", controller_id=controller_id))
+            next_profile_id = min(free_ids)
         
         return render_template("add_time_profile.html", controller_id=controller_id, next_profile_id=next_profile_id, controllers=controllers)
     
     if request.method == "POST":
-        day_mapping = {
-            "Mon": "Monday",
-            "Tue": "Tuesday",
-            "Tues": "Tuesday",
-            "Wed": "Wednesday",
-            "Weds": "Wednesday",
-            "Thur": "Thursday",
-            "Thurs": "Thursday",
-            "Fri": "Friday",
-            "Sat": "Saturday",
-            "Sun": "Sunday"
-        }
-
-        # Split the input string into a list of day names while removing spaces
-        weekdays = request.form.get("weekdays").replace(" ", "").split(",")
+        finalized_days = expand_weekdays(request.form.get("weekdays"))
 
-        # Use the dictionary to expand abbreviated day names to full day names
-        finalized_days = []
-        for day in weekdays:
-            finalized_days.append(day_mapping.get(day.strip(), day.strip()))
-
-        finalized_days = ",".join(finalized_days)
         # Handle form submission for creating a new time profile
         time_profile_id = request.form.get("time_profile_id")
         start_date = request.form.get("start_date")
@@ -1422,16 +1517,13 @@ def add_time_profile(controller_id):
             "end-date": end_date,
             "weekdays": finalized_days,
         }
-        time_profile_data['segments'] = [{"start": segment_start, "end": segment_end}, {'start': '00:00', 'end': '00:00'}, {'start': '00:00', 'end': '00:00'}]
+        time_profile_data['segments'] = [{"start": segment_start, "end": segment_end}, *UNUSED_SEGMENTS]
 
         # Apply to all selected controllers
         success_count = 0
         failed_controllers = []
         
-        for ctrl_id in selected_controllers:
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{ctrl_id}/time-profile/{time_profile_id}"
-            response = requests.put(url, json=time_profile_data)
-            
+        for ctrl_id, response in put_time_profile(selected_controllers, time_profile_id, time_profile_data):
             if response.status_code == 200:
                 success_count += 1
                 # Invalidate time profile cache for this controller
@@ -1479,7 +1571,7 @@ def add_time_profile(controller_id):
 #         print(json.dumps(time_profile_data, indent=3))
 #         # Make a POST request to create the time profile
 
-#         url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time-profile/{time_profile_id}"
+#         url = device_url(controller_id, 'time-profile', time_profile_id)
 #         response = requests.put(
 #             url, json=time_profile_data
 #         )
@@ -1493,16 +1585,12 @@ def add_time_profile(controller_id):
 
 @doorctl.route("/accesscontrol/controller/<int:controller_id>/time_profiles", methods=["GET"])
 def get_time_profiles(controller_id):
-    # Make a GET request to retrieve the list of time profiles for the device
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time-profiles"
-    response = requests.get(url)
+    time_profiles_data = cached_time_profiles(controller_id)
 
-    if response.status_code == 200:
-        time_profiles_data = response.json()
-        print(time_profiles_data)
+    if time_profiles_data:
         return render_template("get_time_profiles.html", controller_id=controller_id, time_profiles=time_profiles_data)
     else:
-        flash(f"Failed to retrieve time profiles. Status code: {response.status_code}", "danger")
+        flash("Failed to retrieve time profiles.", "danger")
 
     return render_template("get_time_profiles.html", controller_id=controller_id)
 
@@ -1517,7 +1605,7 @@ def edit_time_profile(controller_id, profile_id):
     # GET request - fetch existing profile data and controller list
     if request.method == "GET":
         # Get all controllers from config
-        api_config = parse_uhppoted_config('/etc/uhppoted/uhppoted.conf')
+        api_config = get_uhppoted_config()
         controllers = []
         for ctrl_id, ctrl_info in api_config['devices'].items():
             controllers.append({
@@ -1525,8 +1613,8 @@ def edit_time_profile(controller_id, profile_id):
                 'name': ctrl_info.get('name', f'Controller {ctrl_id}')
             })
         
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time-profile/{profile_id}"
-        response = requests.get(url)
+        url = device_url(controller_id, 'time-profile', profile_id)
+        response = http_session.get(url)
         
         if response.status_code == 200:
             profile_data = response.json().get('time-profile', {})
@@ -1536,25 +1624,8 @@ def edit_time_profile(controller_id, profile_id):
             return redirect(url_for("doorctl.get_time_profiles", controller_id=controller_id))
     
     if request.method == "POST":
-        day_mapping = {
-            "Mon": "Monday",
-            "Tue": "Tuesday",
-            "Tues": "Tuesday",
-            "Wed": "Wednesday",
-            "Weds": "Wednesday",
-            "Thur": "Thursday",
-            "Thurs": "Thursday",
-            "Fri": "Friday",
-            "Sat": "Saturday",
-            "Sun": "Sunday"
-        }
-
         # Process weekdays
-        weekdays = request.form.get("weekdays").replace(" ", "").split(",")
-        finalized_days = []
-        for day in weekdays:
-            finalized_days.append(day_mapping.get(day.strip(), day.strip()))
-        finalized_days = ",".join(finalized_days)
+        finalized_days = expand_weekdays(request.form.get("weekdays"))
 
         # Get form data
         start_date = request.form.get("start_date")
@@ -1575,20 +1646,13 @@ def edit_time_profile(controller_id, profile_id):
             "end-date": end_date,
             "weekdays": finalized_days,
         }
-        time_profile_data['segments'] = [
-            {"start": segment_start, "end": segment_end},
-            {'start': '00:00', 'end': '00:00'},
-            {'start': '00:00', 'end': '00:00'}
-        ]
+        time_profile_data['segments'] = [{"start": segment_start, "end": segment_end}, *UNUSED_SEGMENTS]
 
         # Apply to all selected controllers
         success_count = 0
         failed_controllers = []
         
-        for ctrl_id in selected_controllers:
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{ctrl_id}/time-profile/{profile_id}"
-            response = requests.put(url, json=time_profile_data)
-            
+        for ctrl_id, response in put_time_profile(selected_controllers, profile_id, time_profile_data):
             if response.status_code == 200:
                 success_count += 1
                 # Invalidate time profile cache for this controller
@@ -1615,19 +1679,10 @@ def delete_time_profile(controller_id, profile_id):
     
     try:
         # Clear the time profile by setting it to an expired/inactive state
-        # We use a past date range and minimal weekdays to effectively disable it
-        time_profile_data = {
-            "id": profile_id,
-            "start-date": "2000-01-01",
-            "end-date": "2000-01-02",
-            "weekdays": "Monday",  # Required field, cannot be empty
-            "segments": [
-                {'start': '00:00', 'end': '00:00'}
-            ]
-        }
+        time_profile_data = dict(DISABLED_TIME_PROFILE, id=profile_id)
         
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time-profile/{profile_id}"
-        response = requests.put(url, json=time_profile_data)
+        url = device_url(controller_id, 'time-profile', profile_id)
+        response = http_session.put(url, json=time_profile_data)
         
         if response.status_code == 200:
             # Invalidate time profile cache
@@ -1635,8 +1690,7 @@ def delete_time_profile(controller_id, profile_id):
             current_app.logger.info(f"Cache invalidated after deleting time profile {profile_id} on controller {controller_id}")
             flash(f"Time profile {profile_id} deleted successfully.", "success")
         else:
-            error_msg = response.json().get('message', 'Unknown error') if response.headers.get('content-type') == 'application/json' else response.text
-            flash(f"Failed to delete time profile {profile_id}: {error_msg}", "danger")
+            flash(f"Failed to delete time profile {profile_id}: {response_error(response)}", "danger")
     except Exception as e:
         flash(f"Error: {str(e)}", "danger")
     
@@ -1647,8 +1701,8 @@ def delete_time_profile(controller_id, profile_id):
 
 def get_door_states(controller_id):
     # Query door states
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/status"
-    status_response = requests.get(url)
+    url = device_url(controller_id, 'status')
+    status_response = http_session.get(url)
 
     if status_response.status_code == 200:
         status_data = status_response.json()
@@ -1657,13 +1711,22 @@ def get_door_states(controller_id):
         door_states = {}
     return door_states
 
-def get_time_profiles(controller_id):
+def cached_time_profiles(controller_id):
+    # Cached per controller (30 min TTL), invalidated when a profile is added, edited or deleted
+    time_profile_key = f"controller_{controller_id}_time_profiles"
+    time_profiles_data = cache_manager.get(time_profile_key)
+    if time_profiles_data:
+        current_app.logger.debug("Using cached time profiles for controller %s", controller_id)
+        return time_profiles_data
+
     # Make a GET request to retrieve the list of time profiles for the device
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time-profiles"
-    response_timeprofile = requests.get(url, timeout=3)
+    current_app.logger.debug("Cache miss - fetching time profiles for controller %s", controller_id)
+    url = device_url(controller_id, 'time-profiles')
+    response_timeprofile = http_session.get(url, timeout=3)
 
     if response_timeprofile.status_code == 200:
-        time_profiles_data = response_timeprofile.json()
+        time_profiles_data = response_json(response_timeprofile)
+        cache_manager.set(time_profile_key, time_profiles_data)
         return time_profiles_data
     else:
         return None
@@ -1681,17 +1744,16 @@ def show_cards(controller_id):
     else:
         current_app.logger.debug(f"Using cached door states for controller {controller_id}")
 
-    # Always fetch fresh user metadata from database (fast)
-    db_cards = CardMemberMapping.query.all()
-    card_data = {card.card_number: (card.name, card.email, card.membership_type, card.note) for card in db_cards}
+    # User metadata from the database (cached until the card table changes)
+    card_data = card_lookup()
 
     # Cache card list (30 min TTL)
     cards_key = f"controller_{controller_id}_cards_list"
     cards_list = cache_manager.get(cards_key)
     if not cards_list:
         current_app.logger.debug(f"Cache miss - fetching card list for controller {controller_id}")
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/cards"
-        response = requests.get(url)
+        url = device_url(controller_id, 'cards')
+        response = http_session.get(url)
         if response.status_code == 200:
             cards_list = response.json()['cards']
             cache_manager.set(cards_key, cards_list)
@@ -1700,77 +1762,54 @@ def show_cards(controller_id):
     else:
         current_app.logger.debug(f"Using cached card list for controller {controller_id}")
     
-    data = {}
-    deactivated_data = {}
-    
+    # Cached card details first; the misses are fetched concurrently below
+    card_details_map = {}
+    missing_cards = []
     for card_number in cards_list:
-        if card_number in card_data:
-            name, email, membership_type, note = card_data[card_number]
+        card_details = cache_manager.get(f"controller_{controller_id}_card_{card_number}")
+        if card_details:
+            card_details_map[card_number] = card_details
         else:
-            name, email, membership_type, note = ("Undefined", "Undefined", "Undefined", None)
-        
-        # Cache individual card details
-        card_detail_key = f"controller_{controller_id}_card_{card_number}"
-        card_details = cache_manager.get(card_detail_key)
-        if not card_details:
-            current_app.logger.debug(f"Cache miss - fetching card {card_number} details for controller {controller_id}")
-            card_url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-            card_response = requests.get(card_url)
+            missing_cards.append(card_number)
+
+    if missing_cards:
+        current_app.logger.debug("Cache miss - fetching %d card details for controller %s", len(missing_cards), controller_id)
+
+        def fetch_card(card_number):
+            return http_session.get(device_url(controller_id, 'card', card_number))
+
+        for card_number, card_response in fan_out(fetch_card, missing_cards):
             if card_response.status_code == 200:
-                card_details = card_response.json()['card']
-                cache_manager.set(card_detail_key, card_details)
-        else:
-            current_app.logger.debug(f"Using cached card {card_number} details for controller {controller_id}")
-        
-        # Check if deactivated
-        is_deactivated = False
-        if card_details:
-            doors = card_details.get('doors', {})
-            # Check if all doors are set to 0 (deny) - API uses 0=deny, 1=allow
-            if doors and all(value == 0 for value in doors.values()):
-                is_deactivated = True
-        
-        card_info = {"name": name, "email": email, "membership_type": membership_type, "note": note}
-        
-        if is_deactivated:
-            deactivated_data[card_number] = card_info
+                card_details = response_json(card_response)['card']
+                cache_manager.set(f"controller_{controller_id}_card_{card_number}", card_details)
+                card_details_map[card_number] = card_details
+
+    # Rows for the template, in card number order
+    cards = []
+    deactivated_cards = []
+    for card_number in sorted(cards_list):
+        card = CardRow(card_number, *card_data.get(card_number, UNKNOWN_MEMBER))
+
+        # Deactivated when all doors are set to 0 (deny) - API uses 0=deny, 1=allow
+        doors = (card_details_map.get(card_number) or {}).get('doors')
+        if doors and all(value == 0 for value in doors.values()):
+            deactivated_cards.append(card)
         else:
-            data[card_number] = card_info
+            cards.append(card)
 
-    # Cache time profiles (30 min TTL)
-    time_profile_key = f"controller_{controller_id}_time_profiles"
-    time_profile_data = cache_manager.get(time_profile_key)
-    if not time_profile_data:
-        current_app.logger.debug(f"Cache miss - fetching time profiles for controller {controller_id}")
-        time_profile_data = get_time_profiles(controller_id)
-        cache_manager.set(time_profile_key, time_profile_data)
-    else:
-        current_app.logger.debug(f"Using cached time profiles for controller {controller_id}")
+    time_profile_data = cached_time_profiles(controller_id)
 
-    return render_template('cards.html', time_profiles_data=time_profile_data, door_states=door_states, card_data=data, deactivated_data=deactivated_data, controller_id=controller_id)
+    return render_template('cards.html', time_profiles_data=time_profile_data, door_states=door_states, cards=cards, deactivated_cards=deactivated_cards, controller_id=controller_id)
 
 
 @doorctl.route('/accesscontrol/controller/<int:controller_id>/card/<int:card_number>/show', methods=['GET'])
 def get_card(controller_id, card_number):
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-    response = requests.get(url)
+    url = device_url(controller_id, 'card', card_number)
+    response = http_session.get(url)
     
-    # Fetch user data from database
-    try:
-        card_user = CardMemberMapping.query.filter_by(card_number=card_number).first()
-        user_data = {
-            'name': card_user.name if card_user else 'Undefined',
-            'email': card_user.email if card_user else 'Undefined',
-            'membership_type': card_user.membership_type if card_user else 'Undefined',
-            'note': card_user.note if card_user else None
-        }
-    except Exception as e:
-        user_data = {
-            'name': 'Undefined',
-            'email': 'Undefined',
-            'membership_type': 'Undefined',
-            'note': None
-        }
+    # User data from the database (cached until the card table changes)
+    name, email, membership_type, note = card_lookup().get(card_number, UNKNOWN_MEMBER)
+    user_data = {'name': name, 'email': email, 'membership_type': membership_type, 'note': note}
     
     return render_template('get_card.html', controller_id=controller_id, card_data=response.json()['card'], user_data=user_data)
 
@@ -1789,21 +1828,13 @@ def edit_card_on_controller(controller_id, card_number):
             'card-number': int(card_number),
             'start-date': start_date,
             'end-date': end_date,
-            'pin': int(pin) if pin != '' else None
+            'pin': int(pin) if pin != '' else None,
+            'doors': {str(i): door_permission(value) for i, value in enumerate(doors, start=1)}
         }
-        card_data['doors'] = {}
-
-        for i, value in enumerate(doors, start=1):
-            if value == '0':
-                card_data['doors'][str(i)] = 1
-            elif value == '1':
-                card_data['doors'][str(i)] = 0
-            else:
-                card_data['doors'][str(i)] = int(value)
 
         # Update card on controller
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-        response = requests.put(url, json=card_data)
+        url = device_url(controller_id, 'card', card_number)
+        response = http_session.put(url, json=card_data)
         
         if response.status_code == 200:
             # Invalidate relevant caches
@@ -1812,28 +1843,19 @@ def edit_card_on_controller(controller_id, card_number):
             current_app.logger.info(f"Cache invalidated after editing card {card_number} on controller {controller_id}")
             flash(f'Card {card_number} updated successfully on controller', 'success')
         else:
-            error_message = response.json().get('message', 'Error updating card')
+            error_message = response_error(response, 'Error updating card')
             flash(f'Card {card_number} failed to update: {error_message}', 'danger')
 
         # Update global metadata
         try:
-            card_user = CardMemberMapping.query.filter_by(card_number=card_number).one_or_none()
-            if card_user is None:
-                card_user = CardMemberMapping(card_number=card_number)
-            
-            card_user.name = request.form['name']
-            card_user.email = request.form['email']
-            card_user.phone = request.form.get('phone', '')
-            card_user.note = request.form.get('note', '')
-            
             # Handle membership_type with "Other" option
             membership_type = request.form.get('membership_type', '')
             if membership_type == 'Other':
                 membership_type = request.form.get('membership_type_other', '')
-            card_user.membership_type = membership_type
-            
-            db.session.merge(card_user)
-            db.session.commit()
+
+            save_card_user(card_number, name=request.form['name'], email=request.form['email'],
+                           phone=request.form.get('phone', ''), note=request.form.get('note', ''),
+                           membership_type=membership_type)
             flash('Card metadata updated successfully', 'success')
         except Exception as e:
             db.session.rollback()
@@ -1842,8 +1864,8 @@ def edit_card_on_controller(controller_id, card_number):
         return redirect(url_for('doorctl.show_cards', controller_id=controller_id))
 
     # GET request - fetch card data
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-    response = requests.get(url)
+    url = device_url(controller_id, 'card', card_number)
+    response = http_session.get(url)
     
     if response.status_code != 200:
         flash(f'Failed to retrieve card {card_number} from controller', 'danger')
@@ -1852,27 +1874,15 @@ def edit_card_on_controller(controller_id, card_number):
     card_data = response.json()['card']
     
     # Fetch user data from database
-    try:
-        card_user = CardMemberMapping.query.filter_by(card_number=card_number).first()
-        user_data = {
-            'name': card_user.name if card_user else '',
-            'email': card_user.email if card_user else '',
-            'phone': card_user.phone if card_user else '',
-            'note': card_user.note if card_user else '',
-            'membership_type': card_user.membership_type if card_user else ''
-        }
-    except Exception as e:
-        user_data = {
-            'name': '',
-            'email': '',
-            'phone': '',
-            'note': '',
-            'membership_type': ''
-        }
+    card_user = db.session.execute(CARD_USER_SELECT, {'card_number': card_number}).first()
+    if card_user is None:
+        user_data = dict.fromkeys(CARD_USER_FIELDS, '')
+    else:
+        user_data = dict(card_user._mapping)
     
     # Get door states and time profiles
     door_states = get_door_states(controller_id)
-    time_profile_data = get_time_profiles(controller_id)
+    time_profile_data = cached_time_profiles(controller_id)
     
     return render_template('edit_card.html',
                          controller_id=controller_id,
@@ -1884,7 +1894,6 @@ def edit_card_on_controller(controller_id, card_number):
 
 @doorctl.route('/accesscontrol/controller/<int:controller_id>/add_card', methods=['POST'])
 def add_card(controller_id):
-    door_states = get_door_states(controller_id)
     # Extract card details from the form data
     card_number = request.form['card_number']
     start_date = request.form['start_date']
@@ -1899,21 +1908,13 @@ def add_card(controller_id):
         'start-date': start_date,
         'end-date': end_date,
         # 'doors': {"1":True,"2":False,"3":False,"4":True},
-        'pin': int(pin) if pin != '' else None
+        'pin': int(pin) if pin != '' else None,
+        'doors': {str(i): door_permission(value) for i, value in enumerate(doors, start=1)}
     }
-    card_data['doors'] = {}
-
-    for i, value in enumerate(doors, start=1):
-        if value == '0':
-            card_data['doors'][str(i)] = 1
-        elif value == '1':
-            card_data['doors'][str(i)] = 0
-        else:
-            card_data['doors'][str(i)] = int(value)
 
     # Send a PUT request to add the card
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-    response = requests.put(url, json=card_data)
+    url = device_url(controller_id, 'card', card_number)
+    response = http_session.put(url, json=card_data)
     if response.status_code == 200:
         # Invalidate relevant caches
         cache_manager.invalidate(f"controller_{controller_id}_cards_list")
@@ -1924,49 +1925,24 @@ def add_card(controller_id):
         
         # Save global metadata to database
         try:
-            card_user = CardMemberMapping.query.filter_by(card_number=int(card_number)).one_or_none()
-            if card_user is None:
-                card_user = CardMemberMapping(card_number=int(card_number))
-            
-            card_user.name = request.form.get('name', '')
-            card_user.email = request.form.get('email', '')
-            card_user.phone = request.form.get('phone', '')
-            card_user.note = request.form.get('note', '')
-            
             # Handle membership_type with "Other" option
             membership_type = request.form.get('membership_type', '')
             if membership_type == 'Other':
                 membership_type = request.form.get('membership_type_other', '')
-            card_user.membership_type = membership_type
-            
-            db.session.merge(card_user)
-            db.session.commit()
+
+            save_card_user(int(card_number), name=request.form.get('name', ''), email=request.form.get('email', ''),
+                           phone=request.form.get('phone', ''), note=request.form.get('note', ''),
+                           membership_type=membership_type)
             flash('Card metadata saved successfully', 'success')
         except Exception as e:
             db.session.rollback()
             flash(f'Error saving card metadata: {str(e)}', 'warning')
     else:
-        error_message = response.json().get('message', 'Error adding card')
-        response = response.json()['message']
+        error_message = response_error(response, 'Error adding card')
         flash(
-            f'Card {card_number} failed to add, server response: {response}', 'danger')
-
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/cards"
-    response = requests.get(url)
-    db_cards = CardMemberMapping.query.all()
-    card_data = {card.card_number: (card.name, card.email, card.membership_type) for card in db_cards}
+            f'Card {card_number} failed to add, server response: {error_message}', 'danger')
 
-    data = {}
-    if response.status_code == 200:
-        for card_number in response.json()['cards']:
-            if card_number in card_data:
-                name, email, membership_type = card_data[card_number]
-            else:
-                name, email, membership_type = ("", "", "")
-            data[card_number] = {"name": name, "email": email, "membership-type": membership_type}
-
-    time_profile_data = get_time_profiles(controller_id)
-    return render_template('cards.html', time_profiles_data=time_profile_data, door_states=door_states, controller_id=controller_id, card_data=data)
+    return redirect(url_for('doorctl.show_cards', controller_id=controller_id))
 
 
 @doorctl.route('/accesscontrol/controller/<int:controller_id>/delete_card', methods=['POST'])
@@ -1976,8 +1952,8 @@ def delete_card(controller_id):
     try:
         # Send a DELETE request to delete the card from the controller only
         # Do NOT delete from database - card metadata should persist across controllers
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-        response = requests.delete(url)
+        url = device_url(controller_id, 'card', card_number)
+        response = http_session.delete(url)
         if response.status_code == 200:
             # Invalidate relevant caches
             cache_manager.invalidate(f"controller_{controller_id}_cards_list")
@@ -1999,8 +1975,8 @@ def delete_card_user(controller_id, card_number):
     try:
         # Send a DELETE request to delete the card from the controller only
         # Do NOT delete from database - card metadata should persist across controllers
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-        response = requests.delete(url)
+        url = device_url(controller_id, 'card', card_number)
+        response = http_session.delete(url)
         if response.status_code == 200:
             # Invalidate relevant caches
             cache_manager.invalidate(f"controller_{controller_id}_cards_list")
@@ -2022,48 +1998,38 @@ def deactivate_card(controller_id):
     reason = request.form.get('reason', '').strip()
     
     try:
-        # First, get the current card data
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-        response = requests.get(url)
-        
-        if response.status_code == 200:
-            card_data = response.json()['card']
-            
+        # First, get the current card data. Always fresh from the controller: the
+        # cached copy is for display and may be out of date, writing it back could
+        # restore old dates/PIN or re-create a card deleted elsewhere
+        url = device_url(controller_id, 'card', card_number)
+        response = http_session.get(url)
+        card_data = response_json(response)['card'] if response.status_code == 200 else None
+        
+        if card_data:
             # Update the card with all relays set to deny (API uses 0=deny, 1=allow)
             # Set all door permissions to 0 (deny)
-            card_data['doors'] = {
+            card_data = dict(card_data, doors={
                 '1': 0,  # Relay 1 - Deny
                 '2': 0,  # Relay 2 - Deny
                 '3': 0,  # Relay 3 - Deny
                 '4': 0   # Relay 4 - Deny
-            }
+            })
             
             # Send a PUT request to update the card
-            url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/card/{card_number}"
-            response = requests.put(url, json=card_data)
+            response = http_session.put(url, json=card_data)
             
             if response.status_code == 200:
-                # Invalidate relevant caches
-                cache_manager.invalidate(f"controller_{controller_id}_card_{card_number}")
+                # Cache the card as written (so show_cards needn't GET it again) and
+                # invalidate the aggregated global list
+                cache_manager.set(f"controller_{controller_id}_card_{card_number}", card_data)
                 cache_manager.invalidate("global_cards_aggregated")
-                current_app.logger.info(f"Cache invalidated after deactivating card {card_number} on controller {controller_id}")
+                current_app.logger.info(f"Cache updated after deactivating card {card_number} on controller {controller_id}")
                 
                 # Update card note if reason was provided
                 if reason:
                     try:
-                        card_user = CardMemberMapping.query.filter_by(card_number=int(card_number)).one_or_none()
-                        if card_user:
-                            # Get current timestamp
-                            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            deactivation_note = f"[DEACTIVATED {timestamp}] {reason}"
-                            
-                            # Append to existing note or create new note
-                            if card_user.note and card_user.note.strip():
-                                card_user.note = f"{card_user.note}\n{deactivation_note}"
-                            else:
-                                card_user.note = deactivation_note
-                            
-                            db.session.commit()
+                        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        if append_card_note(int(card_number), f"[DEACTIVATED {timestamp}] {reason}"):
                             current_app.logger.info(f"Updated note for card {card_number} with deactivation reason")
                             flash(f'Card {card_number} deactivated successfully and note updated', 'success')
                         else:
@@ -2089,8 +2055,8 @@ def controller_manage(controller_id):
     # Fetch the device time from the API
     event = None
     try:
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/event/last"
-        response = requests.get(url, headers={'accept': 'application/json'})
+        url = device_url(controller_id, 'event', 'last')
+        response = http_session.get(url, headers=HEADERS)
         event = response.json().get('event')
     except ValueError:
         # There's an issue with the response format (e.g., not a valid JSON)
@@ -2102,14 +2068,13 @@ def controller_manage(controller_id):
 @doorctl.route('/accesscontrol/controller/<int:controller_id>/get_time', methods=['GET'])
 def get_device_time(controller_id):
     # Fetch the device time from the API
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time"
-    response = requests.get(url, headers=HEADERS)
+    url = device_url(controller_id, 'time')
+    response = http_session.get(url, headers=HEADERS)
     if response.status_code == 200:
         device_time = response.json()
         return f"Device current time: {device_time['datetime']}"
     elif response.status_code == 500:
-        error = response.json()['message']
-        error_message = f'Error getting time: {error}'
+        error_message = f'Error getting time: {response_error(response)}'
         return error_message
 
 @doorctl.route('/accesscontrol/ajax/get_server_time')
@@ -2128,8 +2093,8 @@ def set_device_time(controller_id):
     # Get the current date and time as a string
     server_datetime = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-    url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time"
-    response = requests.get(url, headers=HEADERS)
+    url = device_url(controller_id, 'time')
+    response = http_session.get(url, headers=HEADERS)
     if response.status_code == 200:
         current_device_time = response.json()['datetime']
 
@@ -2158,16 +2123,15 @@ def set_device_time(controller_id):
 
         # Set the device time using the API
 
-        url = f"{current_app.config['REST_ENDPOINT']}/device/{controller_id}/time"
-        response = requests.put(url, json=request_data, headers=HEADERS)
+        url = device_url(controller_id, 'time')
+        response = http_session.put(url, json=request_data, headers=HEADERS)
 
         if response.status_code == 200:
             device_time = response.json()
             flash(
                 f"Device current time set to: {device_time['datetime']}", 'success')
         elif response.status_code == 500:
-            error_message = response.json().get(
-                'message', 'Error setting device date/time')
+            error_message = response_error(response, 'Error setting device date/time')
             flash(error_message, 'danger')
         else:
             flash("Failed to set device time", 'danger')
@@ -2187,68 +2151,20 @@ def export_data_ui():
     """Export database data to JSON file"""
     try:
         include_events = request.args.get('include_events', 'true').lower() == 'true'
+        now = datetime.datetime.now(datetime.timezone.utc)
         
-        # Export users
-        users = CardMemberMapping.query.all()
-        users_data = []
-        for user in users:
-            users_data.append({
-                'id': user.id,
-                'card_number': user.card_number,
-                'name': user.name,
-                'email': user.email,
-                'phone': user.phone,
-                'login': user.login,
-                'uid': user.uid,
-                'note': user.note,
-                'membership_type': user.membership_type
-            })
-        
-        export_data = {
-            'export_metadata': {
-                'timestamp': datetime.datetime.utcnow().isoformat(),
-                'version': '1.0',
-                'include_events': include_events
-            },
-            'users': users_data
+        export_metadata = {
+            'timestamp': now.isoformat(),
+            'version': '1.0',
+            'include_events': include_events
         }
         
-        # Export events if requested
-        if include_events:
-            events = GlobalEventLog.query.all()
-            events_data = []
-            for event in events:
-                events_data.append({
-                    'id': event.id,
-                    'controller_id': event.controller_id,
-                    'event_id': event.event_id,
-                    'timestamp': event.timestamp,
-                    'timestamp_utc': event.timestamp_utc.isoformat() if event.timestamp_utc else None,
-                    'card_number': event.card_number,
-                    'event_type': event.event_type,
-                    'event_type_text': event.event_type_text,
-                    'access_granted': event.access_granted,
-                    'door_id': event.door_id,
-                    'direction': event.direction,
-                    'direction_text': event.direction_text,
-                    'event_reason': event.event_reason,
-                    'event_reason_text': event.event_reason_text,
-                    'insert_timestamp_utc': event.insert_timestamp_utc.isoformat() if event.insert_timestamp_utc else None,
-                    'name': event.name,
-                    'email': event.email,
-                    'membership_type': event.membership_type
-                })
-            export_data['events'] = events_data
-        
-        # Create filename with timestamp
-        filename = f"door_control_export_{datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
-        json_str = json.dumps(export_data, indent=2)
-        
-        return send_file(
-            io.BytesIO(json_str.encode('utf-8')),
+        # Stream the export as rows come off the cursor instead of building it in memory
+        filename = f"door_control_export_{now.strftime('%Y%m%d_%H%M%S')}.json"
+        return Response(
+            stream_with_context(export_chunks(export_metadata, include_events)),
             mimetype='application/json',
-            as_attachment=True,
-            download_name=filename
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
 
     except Exception as e:
@@ -2277,11 +2193,22 @@ def import_data_ui():
         
         # Read and parse JSON file
         try:
-            import_data = json.load(file)
-        except json.JSONDecodeError as e:
+            import_data = orjson.loads(file.read())
+        except orjson.JSONDecodeError as e:
             flash(f'Invalid JSON file: {str(e)}', 'danger')
             return redirect(url_for('doorctl.data_export_import'))
         
+        # Reject malformed files before anything is cleared or written, the
+        # import commits in batches and can't be undone part way
+        shape_error = import_shape_error(import_data)
+        if shape_error:
+            flash(f'Invalid import file: {shape_error}', 'danger')
+            return redirect(url_for('doorctl.data_export_import'))
+        
+        if mode not in ('merge', 'replace'):
+            flash('Import mode must be "merge" or "replace"', 'danger')
+            return redirect(url_for('doorctl.data_export_import'))
+        
         results = {
             'users': {'added': 0, 'skipped': 0, 'errors': []},
             'events': {'added': 0, 'skipped': 0, 'errors': []}
@@ -2299,102 +2226,11 @@ def import_data_ui():
                 flash(f'Failed to clear existing data: {str(e)}', 'danger')
                 return redirect(url_for('doorctl.data_export_import'))
         
-        # Import users
+        # Batched INSERTs shared with the API import, duplicates are skipped by the database
         users_data = import_data.get('users', [])
-        for user_data in users_data:
-            try:
-                # Check if user exists (by card_number)
-                existing_user = CardMemberMapping.query.filter_by(
-                    card_number=user_data.get('card_number')
-                ).first()
-                
-                if existing_user and skip_duplicates and mode == 'merge':
-                    results['users']['skipped'] += 1
-                    continue
-                
-                # Create new user (id will be auto-generated)
-                new_user = CardMemberMapping(
-                    card_number=user_data.get('card_number'),
-                    name=user_data.get('name'),
-                    email=user_data.get('email'),
-                    phone=user_data.get('phone'),
-                    login=user_data.get('login'),
-                    uid=user_data.get('uid'),
-                    note=user_data.get('note'),
-                    membership_type=user_data.get('membership_type')
-                )
-                
-                db.session.add(new_user)
-                results['users']['added'] += 1
-                
-            except Exception as e:
-                results['users']['errors'].append({
-                    'card_number': user_data.get('card_number'),
-                    'error': str(e)
-                })
-        
-        # Import events if provided
         events_data = import_data.get('events', [])
-        for event_data in events_data:
-            try:
-                # Parse timestamp_utc if it's a string
-                timestamp_utc = None
-                if event_data.get('timestamp_utc'):
-                    timestamp_utc = datetime.datetime.fromisoformat(
-                        event_data['timestamp_utc'].replace('Z', '+00:00')
-                    )
-                
-                insert_timestamp_utc = None
-                if event_data.get('insert_timestamp_utc'):
-                    insert_timestamp_utc = datetime.datetime.fromisoformat(
-                        event_data['insert_timestamp_utc'].replace('Z', '+00:00')
-                    )
-                
-                # Check for duplicate events
-                if skip_duplicates and mode == 'merge':
-                    existing_event = GlobalEventLog.query.filter_by(
-                        controller_id=event_data.get('controller_id'),
-                        event_id=event_data.get('event_id'),
-                        timestamp=event_data.get('timestamp')
-                    ).first()
-                    
-                    if existing_event:
-                        results['events']['skipped'] += 1
-                        continue
-                
-                # Create new event (id will be auto-generated)
-                new_event = GlobalEventLog(
-                    controller_id=event_data.get('controller_id'),
-                    event_id=event_data.get('event_id'),
-                    timestamp=event_data.get('timestamp'),
-                    timestamp_utc=timestamp_utc,
-                    card_number=event_data.get('card_number'),
-                    event_type=event_data.get('event_type'),
-                    event_type_text=event_data.get('event_type_text'),
-                    access_granted=event_data.get('access_granted'),
-                    door_id=event_data.get('door_id'),
-                    direction=event_data.get('direction'),
-                    direction_text=event_data.get('direction_text'),
-                    event_reason=event_data.get('event_reason'),
-                    event_reason_text=event_data.get('event_reason_text'),
-                    insert_timestamp_utc=insert_timestamp_utc,
-                    name=event_data.get('name'),
-                    email=event_data.get('email'),
-                    membership_type=event_data.get('membership_type')
-                )
-                
-                db.session.add(new_event)
-                results['events']['added'] += 1
-                
-            except Exception as e:
-                results['events']['errors'].append({
-                    'event_id': event_data.get('event_id'),
-                    'error': str(e)
-                })
-        
-        # Commit all changes
         try:
-            db.session.commit()
+            import_rows(users_data, events_data, mode, skip_duplicates, results)
             
             # Build success message
             message_parts = []
@@ -2420,7 +2256,10 @@ def import_data_ui():
                 
         except Exception as e:
             db.session.rollback()
-            flash(f'Failed to commit changes: {str(e)}', 'danger')
+            # Earlier batches are already committed, say how much got in
+            flash(f"Failed to import data: {str(e)}. Already imported before the error: "
+                  f"{results['users']['added']} users ({results['users']['skipped']} skipped), "
+                  f"{results['events']['added']} events ({results['events']['skipped']} skipped)", 'danger')
         
         return redirect(url_for('doorctl.data_export_import'))
 
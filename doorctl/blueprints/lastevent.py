@@ -1,17 +1,43 @@
 import requests
-from flask import Blueprint, jsonify, current_app, request, abort
-from ..db import CardMemberMapping
+from flask import Blueprint, jsonify, request, abort
+from sqlalchemy import bindparam, select
+from ..db import db, CardMemberMapping
+from doorctl.sharedlib.cache import cache_manager
+from doorctl.sharedlib.http_session import session as http_session, response_json
 
 lastevent = Blueprint('lastevent', __name__, url_prefix="/kiosk")
 
 REQUEST_TIMEOUT = 3
+HEADERS = {'accept': 'application/json'}
+
+# Kiosks poll the same controller every second or so; answer them from the
+# cache for this long before asking the controller again
+LAST_EVENT_TTL = 2
+
+# Only the member fields shown on the kiosk, for one card
+MEMBER_SELECT = (
+    select(CardMemberMapping.name, CardMemberMapping.email, CardMemberMapping.membership_type)
+    .where(CardMemberMapping.card_number == bindparam('card_number'))
+    .limit(1)
+)
+
+# uhppoted REST endpoint without a trailing slash, copied from the app config
+# when the blueprint is registered instead of looked up on every poll
+REST_BASE = None
+
+
+@lastevent.record_once
+def load_rest_base(state):
+    global REST_BASE
+    REST_BASE = state.app.config['REST_ENDPOINT'].rstrip('/')
+
 
 def _rest_get(path):
-    base = current_app.config['REST_ENDPOINT'].rstrip('/')
-    url = f"{base}{path}"
-    r = requests.get(url, headers={'accept': 'application/json'}, timeout=REQUEST_TIMEOUT)
+    url = f"{REST_BASE}{path}"
+    # Keep-alive session, so each kiosk poll reuses a pooled connection
+    r = http_session.get(url, headers=HEADERS, timeout=REQUEST_TIMEOUT)
     r.raise_for_status()
-    return r.json()
+    return response_json(r)
 
 @lastevent.get('/controller/<int:controller_id>/events/last')
 def get_last_event(controller_id: int):
@@ -19,6 +45,12 @@ def get_last_event(controller_id: int):
     Returns the latest event for a controller (device) as JSON.
     Caching: uses ETag = event-id to allow the kiosk to poll cheaply.
     """
+    cache_key = f"lastevent_{controller_id}"
+    cached = cache_manager.get(cache_key, ttl=LAST_EVENT_TTL)
+    if cached:
+        if request.headers.get("If-None-Match") == cached["etag"]:
+            return ("", 304, {"ETAG": cached["etag"]})
+        return jsonify(cached["payload"]), 200, {"ETag": cached["etag"]}
 
     try:
 
@@ -55,13 +87,15 @@ def get_last_event(controller_id: int):
     card_number = event.get("card-number")
     enriched = {}
     try:
-    
-        card = 	CardMemberMapping.query.filter_by(card_number=card_number).first() if card_number else None
-        if card:
+        # Read straight from the table (one index seek), so a member registered
+        # in another worker shows up on their first badge-in
+        member = db.session.execute(MEMBER_SELECT, {'card_number': card_number}).first() if card_number else None
+        if member:
+            name, email, membership_type = member
             enriched = {
-                "name": card.name,
-                "email": card.email,
-                "membership-type": card.membership_type
+                "name": name,
+                "email": email,
+                "membership-type": membership_type
             }
     except Exception:
         enriched = {}
@@ -81,6 +115,7 @@ def get_last_event(controller_id: int):
         "event-reason-text": event.get("event-reason-text"),
         **enriched
     }
+    cache_manager.set(cache_key, {"etag": etag, "payload": payload}, ttl=LAST_EVENT_TTL)
     return jsonify(payload), 200, {"ETag": etag}
 
 
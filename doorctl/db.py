@@ -1,13 +1,126 @@
+import sqlite3
+import threading
+import time
+import uuid
+from itertools import chain
+
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import Engine, Index, and_, bindparam, event, exists, func, insert, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from doorctl.sharedlib.cache import cache_manager
 
-db = SQLAlchemy()
+# Objects are serialized right after commit, don't expire them and re-SELECT
+db = SQLAlchemy(session_options={'expire_on_commit': False})
 
 
 def init_db(app):
     db.init_app(app)
 
 
+# SQLite connection settings, applied to every new pooled connection
+SQLITE_PRAGMAS = (
+    # Readers (kiosk polls, listings) no longer wait on a writer, and a
+    # commit is one WAL append instead of two journal fsyncs
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',
+    # Per connection, so keep it modest with a pool of up to 50 (16 MiB)
+    'PRAGMA cache_size=-16384',
+)
+
+
+@event.listens_for(Engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+
+def create_missing_indexes():
+    """
+    Create any model indexes that don't exist yet
+
+    db.create_all() skips tables that already exist, so indexes added to a
+    model later would never reach an existing database without this
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+
+
+def insert_ignoring_conflicts(model, index_elements):
+    """
+    Build an INSERT for model that silently skips rows which would violate
+    the unique index on index_elements
+
+    Uses ON CONFLICT DO NOTHING on SQLite/PostgreSQL and INSERT IGNORE on MySQL
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    if dialect == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    if dialect in ('mysql', 'mariadb'):
+        return insert(model).prefix_with('IGNORE')
+    raise NotImplementedError(f'insert_ignoring_conflicts does not support {dialect}')
+
+
+def upsert(model, index_elements, update_fields):
+    """
+    Build an INSERT for model that updates update_fields instead when a row
+    already holds the same values for the unique index on index_elements
+
+    Uses ON CONFLICT DO UPDATE on SQLite/PostgreSQL and ON DUPLICATE KEY UPDATE on MySQL
+    """
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        stmt = (sqlite if dialect == 'sqlite' else postgresql).insert(model)
+        return stmt.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={field: stmt.excluded[field] for field in update_fields}
+        )
+    if dialect in ('mysql', 'mariadb'):
+        stmt = mysql.insert(model)
+        return stmt.on_duplicate_key_update({field: stmt.inserted[field] for field in update_fields})
+    raise NotImplementedError(f'upsert does not support {dialect}')
+
+
+def insert_unless_exists(model, key_columns):
+    """
+    Build an INSERT for model that skips rows whose key_columns match a stored row
+
+    Behaves like ON CONFLICT DO NOTHING without needing a unique index, each
+    row becomes INSERT ... SELECT ... WHERE NOT EXISTS (NULLs compare equal).
+    Execute it with a list of dicts holding every non primary key column;
+    rows earlier in the same executemany count as stored.
+    """
+    table = model.__table__
+    columns = [column for column in table.columns if not column.primary_key]
+    params = {column.name: bindparam(column.name, type_=column.type) for column in columns}
+
+    values = []
+    for column in columns:
+        default = column.default
+        # INSERT ... SELECT bypasses column defaults, apply SQL expression ones here
+        if default is not None and default.is_clause_element:
+            values.append(func.coalesce(params[column.name], default.arg))
+        else:
+            values.append(params[column.name])
+
+    duplicate = exists().where(and_(*(
+        table.c[name].is_not_distinct_from(params[name]) for name in key_columns
+    )))
+    return insert(table).from_select(
+        [column.name for column in columns],
+        select(*values).where(~duplicate)
+    )
+
+
 class CardMemberMapping(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     card_number = db.Column(db.Integer, unique=True)
@@ -20,6 +133,18 @@ class CardMemberMapping(db.Model):
     membership_type = db.Column(db.String(20))
 
 class GlobalEventLog(db.Model):
+    # Match the ORDER BY timestamp_utc DESC (+ filter) used by the events listing
+    __table_args__ = (
+        Index('ix_events_ts_desc', 'timestamp_utc'),
+        Index('ix_events_ctrl_ts', 'controller_id', 'timestamp_utc'),
+        Index('ix_events_card_ts', 'card_number', 'timestamp_utc'),
+        # Per-door listing of a controller's events
+        Index('ix_events_ctrl_door', 'controller_id', 'door_id'),
+        # Import/sync duplicate checks on (controller_id, event_id, timestamp),
+        # covering the whole key so the NOT EXISTS probe never reads the table
+        Index('ix_events_dedup', 'controller_id', 'event_id', 'timestamp'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     controller_id = db.Column(db.Integer)
     event_id = db.Column(db.Integer)
@@ -40,3 +165,76 @@ class GlobalEventLog(db.Model):
     membership_type = db.Column(db.String(20))
 
 
+# Card lookup shared between requests, rebuilt when the card version moves on.
+# The version pairs this process's commit counter with a token in the shared
+# cache, so commits made by other workers invalidate it as well
+CARD_VERSION_KEY = 'card_lookup_version'
+CARD_VERSION_TTL = 86400
+# Rebuild at least this often (seconds), in case the shared cache is disabled
+CARD_LOOKUP_MAX_AGE = 60
+_card_lock = threading.Lock()
+_card_version = 0
+_card_lookup = (None, 0.0, {})
+
+
+def _current_card_version():
+    return _card_version, cache_manager.get(CARD_VERSION_KEY, ttl=CARD_VERSION_TTL)
+
+
+def card_lookup():
+    """
+    Return {card_number: (name, email, membership_type, note)} for every mapped card
+
+    The dict is cached per process and shared by its request threads, treat
+    it as read-only. It is rebuilt when the card version moves on:
+
+    - a commit in this process that wrote CardMemberMapping rows is seen on
+      the next call
+    - a commit in another worker process is seen once its shared token in
+      the cache table is read, within the cache's MEMO_TTL (1s)
+    - anything else (direct database edits, cache disabled) is picked up
+      after at most CARD_LOOKUP_MAX_AGE seconds
+    """
+    global _card_lookup
+    version = _current_card_version()
+    built_version, built_at, cards = _card_lookup
+    if version == built_version and time.monotonic() - built_at < CARD_LOOKUP_MAX_AGE:
+        return cards
+
+    with _card_lock:
+        if _card_lookup[0] != version or time.monotonic() - _card_lookup[1] >= CARD_LOOKUP_MAX_AGE:
+            stmt = select(CardMemberMapping.card_number, CardMemberMapping.name, CardMemberMapping.email,
+                          CardMemberMapping.membership_type, CardMemberMapping.note)
+            # Own connection, so an open transaction in the caller's session can't hand us a stale snapshot
+            with db.engine.connect() as conn:
+                cards = {card_number: tuple(values) for card_number, *values in conn.execute(stmt)}
+            _card_lookup = (version, time.monotonic(), cards)
+        return _card_lookup[2]
+
+
+@event.listens_for(Session, 'after_flush')
+def _flag_card_flush(session, flush_context):
+    if any(isinstance(obj, CardMemberMapping) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info['cards_changed'] = True
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _flag_card_statement(orm_execute_state):
+    # Bulk INSERT/UPDATE/DELETE statements (e.g. imports, query.delete()) skip the flush
+    if not orm_execute_state.is_select and orm_execute_state.bind_mapper is CardMemberMapping.__mapper__:
+        orm_execute_state.session.info['cards_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_card_version(session):
+    global _card_version
+    if session.info.pop('cards_changed', False):
+        with _card_lock:
+            _card_version += 1
+        # Tell the other workers their lookup is stale
+        cache_manager.set(CARD_VERSION_KEY, uuid.uuid4().hex, ttl=CARD_VERSION_TTL)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _clear_card_flag(session):
+    session.info.pop('cards_changed', None)
@@ -0,0 +1,25 @@
+# Filename    : gunicorn_conf.py
+# Author      : Jon Kelley <jon.kelley@kzoomakers.org>
+# Description : Gunicorn settings for serving doorctl.runserver:app
+
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5001')
+
+# Requests mostly wait on the controllers' REST endpoint or SQLite, so run a
+# few processes with a pool of threads each. Per-process state such as
+# db.card_lookup() is invalidated across workers through the shared cache
+workers = int(os.environ.get('GUNICORN_WORKERS', '4'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+
+# Controller fan-outs can take a while on slow networks
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+
+accesslog = '-'
+
+
+def on_starting(server):
+    # Create tables once in the master rather than racing in every worker
+    from doorctl.runserver import setup_database
+    setup_database()
@@ -7,13 +7,14 @@ from doorctl.blueprints.doorctl import doorctl
 from doorctl.blueprints.lastevent import lastevent
 from doorctl.blueprints.api import api
 from doorctl.sharedlib.jinja2 import split_list_one, split_list_two, reverse_string, resume_date, calculate_age, make_slug
+from doorctl.sharedlib.json_provider import OrjsonProvider
 import base64
 import os
 from datetime import datetime
 import time
 from dateutil import tz
 from flask_sqlalchemy import SQLAlchemy
-from .db import db, init_db
+from .db import db, init_db, create_missing_indexes
 import logging
 
 os.environ['TZ'] = os.environ.get('TIMEZONE')
@@ -21,6 +22,7 @@ time.tzset()
 
 
 app = Flask(__name__, static_url_path='/accesscontrol/static')
+app.json = OrjsonProvider(app)
 
 app.logger.setLevel(logging.DEBUG)
 stream_handler = logging.StreamHandler()
@@ -50,11 +52,19 @@ db_path = os.path.abspath(os.path.join(app.instance_path, 'flask_database.db'))
 # Configure the database URI with the absolute path
 #app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:////door/flask_database.db'
+# Size the connection pool for concurrent requests instead of the 5+10 default
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', '25')),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '25')),
+    'pool_pre_ping': True,
+    'pool_recycle': 1800
+}
 
 
 app.register_blueprint(doorctl)
 app.register_blueprint(lastevent)
 app.register_blueprint(api)
+init_db(app)
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -68,11 +78,24 @@ def internal_server_error(e):
     return render_template('500.html'), 500
 
 
-def main():
-    init_db(app)
+def setup_database():
+    """
+    Create missing tables and indexes, run once before serving
+
+    Under gunicorn this runs in the master process (see gunicorn_conf.py), so
+    the pooled connections are dropped again before workers are forked
+    """
     with app.app_context():
         db.create_all()
-    app.run(host='0.0.0.0', debug=True, port=5001, threaded=True)
+        create_missing_indexes()
+        db.engine.dispose()
+
+
+def main():
+    # Development server; production runs under gunicorn:
+    #   gunicorn -c python:doorctl.gunicorn_conf doorctl.runserver:app
+    setup_database()
+    app.run(host='0.0.0.0', port=5001, threaded=True)
 
 if __name__ == '__main__':
     main()
@@ -1,29 +1,48 @@
 # Filename    : cache.py
 # Author      : Jon Kelley <jon.kelley@kzoomakers.org>
-# Description : Thread-safe JSON file cache manager for multi-worker environments
+# Description : Thread-safe SQLite cache manager for multi-worker environments
 
-import json
+from fnmatch import fnmatchcase
 import os
+import sqlite3
+import threading
 import time
-import fcntl
-from datetime import datetime, timedelta
 from pathlib import Path
 import logging
-import glob
+
+import orjson
 
 # Default cache configuration
 CACHE_DIR = os.environ.get('CACHE_DIR', '/tmp/door_control_cache')
 DEFAULT_TTL = int(os.environ.get('CACHE_TTL', '1800'))  # 30 minutes in seconds
 CACHE_ENABLED = os.environ.get('CACHE_ENABLED', 'true').lower() == 'true'
+CACHE_DB_NAME = 'cache.db'
+# Some cached dicts are keyed by card number; their keys come back as strings
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+# How long a worker answers a key from memory before reading the shared table
+# again; bounds how stale it can be after another worker sets or invalidates
+MEMO_TTL = 1
 
 
 class CacheManager:
-    """Thread-safe JSON file cache manager for multi-worker environments"""
+    """
+    Thread-safe cache manager for multi-worker environments
+
+    Entries live in one SQLite table in WAL mode, so workers share them and
+    readers never block the writer. Values are stored as orjson blobs.
+    """
     
     def __init__(self, cache_dir=CACHE_DIR, enabled=CACHE_ENABLED):
         self.cache_dir = Path(cache_dir)
+        self.db_path = self.cache_dir / CACHE_DB_NAME
         self.enabled = enabled
         self.logger = logging.getLogger(__name__)
+        # One connection per thread (and per process after a fork)
+        self._local = threading.local()
+        # cache_key -> (memo expiry, orjson bytes) for keys this worker just read
+        # or wrote. Bytes, not objects, so callers never share a mutable value
+        self._memo = {}
+        self._memo_lock = threading.Lock()
         
         # Statistics tracking
         self.stats = {
@@ -34,13 +53,18 @@ class CacheManager:
             'errors': 0
         }
         
-        # Create cache directory if it doesn't exist
+        # Create cache directory and table if they don't exist
         if self.enabled:
             try:
                 self.cache_dir.mkdir(parents=True, exist_ok=True)
-                self.logger.info(f"Cache initialized at {self.cache_dir}")
+                with self._connect() as conn:
+                    conn.execute(
+                        'CREATE TABLE IF NOT EXISTS cache ('
+                        'key TEXT PRIMARY KEY, expires_at REAL NOT NULL, data BLOB NOT NULL)'
+                    )
+                self.logger.info(f"Cache initialized at {self.db_path}")
             except Exception as e:
-                self.logger.error(f"Failed to create cache directory: {str(e)}")
+                self.logger.error(f"Failed to initialize cache database: {str(e)}")
                 self.enabled = False
     
     def get(self, cache_key, ttl=DEFAULT_TTL):
@@ -57,38 +81,41 @@ class CacheManager:
         if not self.enabled:
             return None
         
+        now = time.time()
+        with self._memo_lock:
+            memo = self._memo.get(cache_key)
+        if memo and memo[0] > now:
+            self.stats['hits'] += 1
+            return orjson.loads(memo[1])
+        
         try:
-            filepath = self._get_cache_filepath(cache_key)
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT expires_at, data FROM cache WHERE key = ?', (cache_key,)
+            ).fetchone()
             
-            if not filepath.exists():
+            if row is None:
                 self.stats['misses'] += 1
-                self.logger.debug(f"Cache MISS: {cache_key} (file not found)")
-                return None
-            
-            # Read cache file with shared lock
-            cache_entry = self._read_cache_file(filepath)
-            
-            if cache_entry is None:
-                self.stats['misses'] += 1
-                self.logger.debug(f"Cache MISS: {cache_key} (invalid file)")
+                self.logger.debug(f"Cache MISS: {cache_key} (not found)")
                 return None
             
             # Check if cache entry has expired
-            expires_at = datetime.fromisoformat(cache_entry['expires_at'])
-            if datetime.utcnow() > expires_at:
+            expires_at, data = row
+            if now > expires_at:
                 self.stats['misses'] += 1
                 self.logger.debug(f"Cache MISS: {cache_key} (expired)")
-                # Clean up expired cache file
-                try:
-                    filepath.unlink()
-                except Exception:
-                    pass
+                # Clean up expired entry (unless another worker just refreshed it)
+                with conn:
+                    conn.execute(
+                        'DELETE FROM cache WHERE key = ? AND expires_at = ?', (cache_key, expires_at)
+                    )
                 return None
             
             # Cache hit!
+            self._remember(cache_key, min(expires_at, now + MEMO_TTL), data)
             self.stats['hits'] += 1
             self.logger.info(f"Cache HIT: {cache_key}")
-            return cache_entry['data']
+            return orjson.loads(data)
             
         except Exception as e:
             self.stats['errors'] += 1
@@ -111,19 +138,14 @@ class CacheManager:
             return False
         
         try:
-            filepath = self._get_cache_filepath(cache_key)
-            
-            # Create cache entry with metadata
-            cache_entry = {
-                'timestamp': datetime.utcnow().isoformat(),
-                'expires_at': (datetime.utcnow() + timedelta(seconds=ttl)).isoformat(),
-                'cache_key': cache_key,
-                'ttl': ttl,
-                'data': data
-            }
-            
-            # Write cache file with exclusive lock
-            self._write_cache_file(filepath, cache_entry)
+            now = time.time()
+            blob = orjson.dumps(data, option=ORJSON_OPTIONS)
+            with self._connect() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache (key, expires_at, data) VALUES (?, ?, ?)',
+                    (cache_key, now + ttl, blob)
+                )
+            self._remember(cache_key, now + min(ttl, MEMO_TTL), blob)
             
             self.stats['sets'] += 1
             self.logger.debug(f"Cache SET: {cache_key}, TTL: {ttl}s")
@@ -147,11 +169,14 @@ class CacheManager:
         if not self.enabled:
             return False
         
+        with self._memo_lock:
+            self._memo.pop(cache_key, None)
+        
         try:
-            filepath = self._get_cache_filepath(cache_key)
+            with self._connect() as conn:
+                deleted = conn.execute('DELETE FROM cache WHERE key = ?', (cache_key,)).rowcount
             
-            if filepath.exists():
-                filepath.unlink()
+            if deleted:
                 self.stats['invalidations'] += 1
                 self.logger.debug(f"Cache INVALIDATE: {cache_key}")
                 return True
@@ -177,17 +202,14 @@ class CacheManager:
         if not self.enabled:
             return 0
         
+        with self._memo_lock:
+            for key in [key for key in self._memo if fnmatchcase(key, pattern)]:
+                del self._memo[key]
+        
         try:
-            count = 0
-            pattern_path = self.cache_dir / f"{pattern}.json"
-            
-            for filepath in glob.glob(str(pattern_path)):
-                try:
-                    Path(filepath).unlink()
-                    count += 1
-                    self.stats['invalidations'] += 1
-                except Exception as e:
-                    self.logger.warning(f"Failed to delete {filepath}: {str(e)}")
+            with self._connect() as conn:
+                count = conn.execute('DELETE FROM cache WHERE key GLOB ?', (pattern,)).rowcount
+            self.stats['invalidations'] += count
             
             self.logger.debug(f"Cache INVALIDATE PATTERN: {pattern} ({count} entries)")
             return count
@@ -199,7 +221,7 @@ class CacheManager:
     
     def clear_all(self):
         """
-        Clear entire cache directory
+        Clear every cache entry
         
         Returns:
             Number of cache entries cleared
@@ -207,15 +229,13 @@ class CacheManager:
         if not self.enabled:
             return 0
         
+        with self._memo_lock:
+            self._memo.clear()
+        
         try:
-            count = 0
-            for filepath in self.cache_dir.glob('*.json'):
-                try:
-                    filepath.unlink()
-                    count += 1
-                    self.stats['invalidations'] += 1
-                except Exception as e:
-                    self.logger.warning(f"Failed to delete {filepath}: {str(e)}")
+            with self._connect() as conn:
+                count = conn.execute('DELETE FROM cache').rowcount
+            self.stats['invalidations'] += count
             
             self.logger.info(f"Cache CLEAR ALL: {count} entries removed")
             return count
@@ -235,20 +255,20 @@ class CacheManager:
         total_requests = self.stats['hits'] + self.stats['misses']
         hit_rate = (self.stats['hits'] / total_requests * 100) if total_requests > 0 else 0
         
-        # Get cache directory size and file count
+        # Get stored entry count and size
         cache_size = 0
-        file_count = 0
-        if self.enabled and self.cache_dir.exists():
-            for filepath in self.cache_dir.glob('*.json'):
-                try:
-                    cache_size += filepath.stat().st_size
-                    file_count += 1
-                except Exception:
-                    pass
+        entry_count = 0
+        if self.enabled:
+            try:
+                entry_count, cache_size = self._connect().execute(
+                    'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM cache'
+                ).fetchone()
+            except Exception:
+                pass
         
         return {
             'enabled': self.enabled,
-            'cache_dir': str(self.cache_dir),
+            'cache_db': str(self.db_path),
             'total_requests': total_requests,
             'hits': self.stats['hits'],
             'misses': self.stats['misses'],
@@ -258,77 +278,34 @@ class CacheManager:
             'errors': self.stats['errors'],
             'cache_size_bytes': cache_size,
             'cache_size_mb': f"{cache_size / 1024 / 1024:.2f}",
-            'file_count': file_count
+            'entry_count': entry_count
         }
     
-    def _get_cache_filepath(self, cache_key):
-        """Get the file path for a cache key"""
-        # Sanitize cache key to be filesystem-safe
-        safe_key = cache_key.replace('/', '_').replace('\\', '_')
-        return self.cache_dir / f"{safe_key}.json"
-    
-    def _read_cache_file(self, filepath):
-        """
-        Read cache file with shared lock
-        
-        Args:
-            filepath: Path to cache file
-            
-        Returns:
-            Cache entry dictionary or None if error
-        """
-        try:
-            with open(filepath, 'r') as f:
-                # Acquire shared lock for reading (multiple readers allowed)
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
-                try:
-                    data = json.load(f)
-                finally:
-                    # Release lock
-                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            return data
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-            self.logger.debug(f"Failed to read cache file {filepath}: {str(e)}")
-            return None
-        except Exception as e:
-            self.logger.error(f"Unexpected error reading cache file {filepath}: {str(e)}")
-            return None
+    def _remember(self, cache_key, memo_expires_at, data):
+        """Keep a key's serialized value in this worker's memo until memo_expires_at"""
+        with self._memo_lock:
+            # Drop stale entries now and then so keys that are never read
+            # again don't pile up
+            if len(self._memo) > 1024:
+                now = time.time()
+                self._memo = {key: memo for key, memo in self._memo.items() if memo[0] > now}
+            self._memo[cache_key] = (memo_expires_at, data)
     
-    def _write_cache_file(self, filepath, data):
+    def _connect(self):
         """
-        Write cache file with exclusive lock using atomic operation
-        
-        Args:
-            filepath: Path to cache file
-            data: Data to write (must be JSON serializable)
+        Return this thread's connection to the cache database, opening it on
+        first use (connections must not cross threads or a fork)
         """
-        # Write to temporary file first, then atomically rename
-        temp_file = filepath.with_suffix('.tmp')
-        
-        try:
-            with open(temp_file, 'w') as f:
-                # Acquire exclusive lock for writing (no other readers or writers)
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                try:
-                    json.dump(data, f, indent=2)
-                    f.flush()
-                    # Ensure data is written to disk
-                    os.fsync(f.fileno())
-                finally:
-                    # Release lock
-                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            
-            # Atomic rename (replaces existing file if present)
-            temp_file.replace(filepath)
-            
-        except Exception as e:
-            # Clean up temp file if it exists
-            if temp_file.exists():
-                try:
-                    temp_file.unlink()
-                except Exception:
-                    pass
-            raise
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5)
+            # WAL lets readers run alongside a writer; a cache can be rebuilt,
+            # so skip the fsync on every commit
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
 
 
 # Global cache manager instance
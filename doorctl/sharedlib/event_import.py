@@ -0,0 +1,55 @@
+# Filename    : event_import.py
+# Author      : Jon Kelley <jon.kelley@kzoomakers.org>
+# Description : Convert imported event objects into database rows
+
+from ciso8601 import parse_datetime
+
+# Event fields imported as-is (the UTC timestamps are parsed separately)
+EVENT_IMPORT_FIELDS = (
+    'controller_id', 'event_id', 'timestamp', 'card_number', 'event_type',
+    'event_type_text', 'access_granted', 'door_id', 'direction', 'direction_text',
+    'event_reason', 'event_reason_text', 'name', 'email', 'membership_type'
+)
+
+
+def prepare_event_rows(events_data):
+    """
+    Build GlobalEventLog insert rows from exported event objects
+
+    Pure Python with no database or Flask access, so it can be called on any
+    slice of an import
+
+    Args:
+        events_data: List of event dicts as found in an export
+
+    Returns:
+        Tuple of (rows, errors); errors holds an entry per event whose
+        timestamps could not be parsed
+    """
+    rows = []
+    errors = []
+    for event_data in events_data:
+        # Parse ISO 8601 timestamps (ciso8601 handles a trailing 'Z' itself),
+        # the only per-row step that can fail on bad input
+        try:
+            timestamp_utc = None
+            if event_data.get('timestamp_utc'):
+                timestamp_utc = parse_datetime(event_data['timestamp_utc'])
+
+            insert_timestamp_utc = None
+            if event_data.get('insert_timestamp_utc'):
+                insert_timestamp_utc = parse_datetime(event_data['insert_timestamp_utc'])
+        except (TypeError, ValueError) as e:
+            errors.append({
+                'event_id': event_data.get('event_id'),
+                'error': str(e)
+            })
+            continue
+
+        # New event row (id will be auto-generated)
+        row = {field: event_data.get(field) for field in EVENT_IMPORT_FIELDS}
+        row['timestamp_utc'] = timestamp_utc
+        row['insert_timestamp_utc'] = insert_timestamp_utc
+        rows.append(row)
+
+    return rows, errors
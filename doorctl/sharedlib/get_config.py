@@ -1,31 +1,49 @@
+import os
 import re
+from functools import lru_cache
 
-def parse_uhppoted_config(config_file):
-    device_pattern = re.compile(r'^(UT\d+-L\d+)\.(\d+)\.name = (.+)$')
-    address_pattern = re.compile(r'^(UT\d+-L\d+)\.(\d+)\.address = (\d+\.\d+\.\d+\.\d+):(\d+)$')
-    timezone_pattern = re.compile(r'^(UT\d+-L\d+)\.(\d+)\.timezone = (.+)$')
+UHPPOTED_CONFIG = '/etc/uhppoted/uhppoted.conf'
 
-    devices = {}
 
-    with open(config_file, 'r') as file:
-        lines = file.readlines()
+# One pattern for every device line we care about: the named group that
+# matched says which setting the line holds
+DEVICE_LINE_PATTERN = re.compile(
+    r'^(?P<model>UT\d+-L\d+)\.(?P<device_id>\d+)\.'
+    r'(?:name = (?P<name>.+)'
+    r'|address = (?P<ipaddr>\d+\.\d+\.\d+\.\d+):\d+'
+    r'|timezone = (?P<timezone>.+))$'
+)
 
+
+def parse_uhppoted_config(config_file):
+    devices = {}
     current_device = None
 
-    for line in lines:
-        device_match = device_pattern.match(line)
-        address_match = address_pattern.match(line)
-        timezone_match = timezone_pattern.match(line)
-
-        if device_match:
-            model, device_id, name = device_match.groups()
-            current_device = devices.setdefault(device_id, {"model": model})
-            current_device["name"] = name
-        elif address_match and current_device:
-            _, _, ipaddr, _ = address_match.groups()
-            current_device["ipaddr"] = ipaddr
-        elif timezone_match and current_device:
-            _, _, timezone = timezone_match.groups()
-            current_device["timezone"] = timezone
+    with open(config_file, 'r') as file:
+        for line in file:
+            match = DEVICE_LINE_PATTERN.match(line)
+            if not match:
+                continue
+
+            if match['name'] is not None:
+                current_device = devices.setdefault(match['device_id'], {"model": match['model']})
+                current_device["name"] = match['name']
+            elif match['ipaddr'] is not None and current_device:
+                current_device["ipaddr"] = match['ipaddr']
+            elif match['timezone'] is not None and current_device:
+                current_device["timezone"] = match['timezone']
 
     return {"devices": devices}
+
+
+@lru_cache(maxsize=4)
+def _parse_uhppoted_config_cached(config_file, mtime_ns):
+    return parse_uhppoted_config(config_file)
+
+
+def get_uhppoted_config(config_file=UHPPOTED_CONFIG):
+    """
+    Return the parsed uhppoted config, only re-parsing the file when its mtime changes.
+    The returned dict is shared between requests, treat it as read-only.
+    """
+    return _parse_uhppoted_config_cached(config_file, os.stat(config_file).st_mtime_ns)
@@ -0,0 +1,77 @@
+# Filename    : http_session.py
+# Author      : Jon Kelley <jon.kelley@kzoomakers.org>
+# Description : Shared HTTP session and fan-out helper for the uhppoted REST endpoint
+
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+
+# Default timeout (seconds) for calls made to the controllers
+REQUEST_TIMEOUT = 5
+
+# (connect, read) timeout for session calls that don't pass their own, so a hung
+# REST endpoint can't hold a worker thread forever
+DEFAULT_TIMEOUT = (2, 10)
+
+
+class TimeoutSession(requests.Session):
+    """requests.Session that applies DEFAULT_TIMEOUT unless the call sets a timeout"""
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+
+# One keep-alive session shared by every request handler. The controllers'
+# REST endpoint is on the local network, so skip the proxy/netrc environment
+# lookups requests would otherwise do on every call.
+session = TimeoutSession()
+session.trust_env = False
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+session.mount('http://', _adapter)
+session.mount('https://', _adapter)
+
+# Long-lived worker pool for fan_out, sized to the connection pool above.
+# Reusing it avoids spawning and joining threads on every request.
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='fan_out')
+
+
+def fan_out(fn, items):
+    """
+    Call fn(item) for every item concurrently
+
+    Args:
+        fn: Callable taking a single item (must not rely on the Flask app context,
+            and must not call fan_out itself since it runs on the shared pool)
+        items: Iterable of items, e.g. controller IDs
+
+    Returns:
+        List of (item, result) tuples in the same order as items
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    return list(zip(items, _executor.map(fn, items)))
+
+
+def response_json(response):
+    """Parse a response body with orjson (much faster than response.json() on big card/event lists)"""
+    return orjson.loads(response.content)
+
+
+def response_error(response, default='Unknown error'):
+    """
+    Return the error message from a controller response
+
+    Uses the 'message' field of a JSON body, the raw body text when the response
+    isn't JSON, and default when neither has anything to show
+    """
+    if 'application/json' in response.headers.get('content-type', ''):
+        try:
+            return orjson.loads(response.content).get('message') or default
+        except (orjson.JSONDecodeError, AttributeError):
+            pass
+    return response.text or default
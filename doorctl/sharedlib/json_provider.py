@@ -0,0 +1,32 @@
+# Filename    : json_provider.py
+# Author      : Jon Kelley <jon.kelley@kzoomakers.org>
+# Description : orjson backed JSON provider for Flask
+
+import orjson
+from flask.json.provider import JSONProvider
+
+# Non-string keys show up in a few places (e.g. dicts keyed by card number)
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS
+
+
+class OrjsonProvider(JSONProvider):
+    """Serialize jsonify() responses and parse request bodies with orjson"""
+
+    def dumps(self, obj, **kwargs):
+        option = ORJSON_OPTIONS
+        if kwargs.get('sort_keys'):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=str, option=option).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # orjson already returns bytes, so skip the str round-trip of the base class
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=str, option=ORJSON_OPTIONS),
+            mimetype='application/json'
+        )
@@ -0,0 +1,24 @@
+# Filename    : json_stream.py
+# Author      : Jon Kelley <jon.kelley@kzoomakers.org>
+# Description : Incremental orjson encoding for streamed responses
+
+import orjson
+
+# Rows encoded per yielded chunk
+CHUNK_ROWS = 1000
+
+
+def json_array(rows, chunk_rows=CHUNK_ROWS):
+    """Encode rows as a JSON array, yielding one bytes chunk per chunk_rows rows"""
+    yield b'['
+    separator = b''
+    batch = []
+    for row in rows:
+        batch.append(orjson.dumps(row))
+        if len(batch) == chunk_rows:
+            yield separator + b','.join(batch)
+            separator = b','
+            batch = []
+    if batch:
+        yield separator + b','.join(batch)
+    yield b']'
@@ -23,7 +23,7 @@ if __name__ == "__main__":
         include_package_data=True,
         package_dir={NAME: NAME},
         description="doorcontrol - kzoomakers.org",
-        install_requires=['Flask-SQLAlchemy', 'SQLAlchemy', 'pytz', 'Flask', 'werkzeug', 'requests', 'unidecode', 'Flask-Session', 'python-dateutil', 'flask-login', 'passlib'],
+        install_requires=['Flask-SQLAlchemy', 'SQLAlchemy', 'Flask', 'werkzeug', 'requests', 'unidecode', 'Flask-Session', 'python-dateutil', 'flask-login', 'passlib', 'orjson', 'ciso8601', 'gunicorn'],
         entry_points={
             'console_scripts': ['doorcontrol = doorctl.runserver:main'],
         },
@@ -0,0 +1,10 @@
+import pytest
+
+import doorctl.db
+from doorctl.sharedlib.cache import CacheManager
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    """Keep the card lookup version token out of the real cache directory"""
+    monkeypatch.setattr(doorctl.db, 'cache_manager', CacheManager(cache_dir=tmp_path / 'cache'))
@@ -0,0 +1,123 @@
+import datetime
+
+import pytest
+from flask import Flask
+
+from doorctl.blueprints.api import api
+from doorctl.db import GlobalEventLog, db, init_db
+from doorctl.sharedlib.json_provider import OrjsonProvider
+
+HEADERS = {'X-API-Key': 'test-key'}
+BASE_TS = datetime.datetime(2024, 5, 1, 10, 0, 0)
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.json = OrjsonProvider(app)
+    app.config['API_KEY'] = 'test-key'
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "doorctl.db"}'
+    app.register_blueprint(api)
+    init_db(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def add_events(app, timestamps):
+    """Store one event per timestamp (None for an event without one), ids in list order"""
+    with app.app_context():
+        db.session.add_all(
+            GlobalEventLog(controller_id=425036451, event_id=i, timestamp_utc=ts)
+            for i, ts in enumerate(timestamps, start=1)
+        )
+        db.session.commit()
+
+
+def page_through(client, limit):
+    """Follow next_cursor from the first page to the end, returning the event ids seen"""
+    response = client.get(f'/api/v1/events?limit={limit}', headers=HEADERS)
+    assert response.status_code == 200
+    seen = [event['id'] for event in response.json['events']]
+    pages = 1
+    while response.json['next_cursor']:
+        response = client.get(f'/api/v1/events?limit={limit}&cursor={response.json["next_cursor"]}', headers=HEADERS)
+        assert response.status_code == 200
+        seen += [event['id'] for event in response.json['events']]
+        pages += 1
+        assert pages < 50
+    return seen
+
+
+def test_cursor_pages_to_the_end(app, client):
+    add_events(app, [BASE_TS + datetime.timedelta(minutes=i) for i in range(7)])
+
+    first = client.get('/api/v1/events?limit=3', headers=HEADERS).json
+    assert [event['id'] for event in first['events']] == [7, 6, 5]
+    assert first['total'] == 7
+    assert first['next_cursor']
+
+    assert page_through(client, 3) == [7, 6, 5, 4, 3, 2, 1]
+
+
+def test_cursor_with_tied_timestamps(app, client):
+    add_events(app, [BASE_TS] * 5 + [BASE_TS + datetime.timedelta(minutes=1)])
+
+    assert page_through(client, 2) == [6, 5, 4, 3, 2, 1]
+
+
+def test_cursor_with_null_timestamps(app, client):
+    add_events(app, [BASE_TS, None, BASE_TS + datetime.timedelta(minutes=1), None, None, BASE_TS])
+
+    # Timestamped events newest first, then the ones without a timestamp
+    assert page_through(client, 2) == [3, 6, 1, 5, 4, 2]
+    assert page_through(client, 1) == [3, 6, 1, 5, 4, 2]
+
+
+@pytest.mark.parametrize('cursor', ['garbage', 'not-a-date_5', '2024-05-01T10:00:00_x'])
+def test_invalid_cursor_returns_400(client, cursor):
+    response = client.get(f'/api/v1/events?cursor={cursor}', headers=HEADERS)
+    assert response.status_code == 400
+    assert response.json['error'] == 'Invalid cursor'
+
+
+def test_limit_zero(app, client):
+    add_events(app, [BASE_TS, BASE_TS + datetime.timedelta(minutes=1)])
+
+    response = client.get('/api/v1/events?limit=0', headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json['limit'] == 1
+    assert [event['id'] for event in response.json['events']] == [2]
+
+
+def test_limit_zero_on_empty_table(client):
+    response = client.get('/api/v1/events?limit=0', headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json['events'] == []
+    assert response.json['next_cursor'] is None
+
+
+def test_api_key_is_read_per_app(app, client, tmp_path):
+    assert client.get('/api/v1/events', headers=HEADERS).status_code == 200
+
+    other = Flask('other')
+    other.json = OrjsonProvider(other)
+    other.config['API_KEY'] = 'other-key'
+    other.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp_path / "other.db"}'
+    other.register_blueprint(api)
+    init_db(other)
+    with other.app_context():
+        db.create_all()
+
+    other_client = other.test_client()
+    assert other_client.get('/api/v1/events', headers=HEADERS).status_code == 403
+    assert other_client.get('/api/v1/events', headers={'X-API-Key': 'other-key'}).status_code == 200
+
+    app.config['API_KEY'] = 'rotated-key'
+    assert client.get('/api/v1/events', headers=HEADERS).status_code == 403
+    assert client.get('/api/v1/events', headers={'X-API-Key': 'rotated-key'}).status_code == 200
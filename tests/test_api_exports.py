@@ -0,0 +1,50 @@
+import fcntl
+import os
+import time
+
+import doorctl.blueprints.api as api_module
+
+
+def make_file(path, age):
+    path.write_bytes(b'{}')
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_purge_keeps_live_jobs_and_recent_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_module, 'EXPORT_DIR', str(tmp_path))
+    old = api_module.EXPORT_RETENTION + 60
+
+    finished = make_file(tmp_path / 'a.json', old)
+    failed = make_file(tmp_path / 'b.json.error', old)
+    abandoned = make_file(tmp_path / 'c.json.part', old)
+    recent = make_file(tmp_path / 'd.json', 0)
+    live = make_file(tmp_path / 'e.json.part', old)
+
+    with open(live, 'rb') as f:
+        # Held like a running _run_export_job does
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        api_module._purge_old_exports()
+
+    assert not finished.exists()
+    assert not failed.exists()
+    assert not abandoned.exists()
+    assert recent.exists()
+    assert live.exists()
+
+
+def test_purge_ignores_files_removed_concurrently(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_module, 'EXPORT_DIR', str(tmp_path))
+    gone = make_file(tmp_path / 'a.json', api_module.EXPORT_RETENTION + 60)
+
+    real_remove = os.remove
+
+    def remove_twice(path):
+        # Another worker's purge got there first
+        real_remove(path)
+        real_remove(path)
+
+    monkeypatch.setattr(api_module.os, 'remove', remove_twice)
+    api_module._purge_old_exports()
+    assert not gone.exists()
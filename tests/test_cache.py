@@ -0,0 +1,18 @@
+from doorctl.sharedlib.cache import CacheManager
+
+
+def test_int_keyed_dict_round_trip(tmp_path):
+    cache = CacheManager(cache_dir=tmp_path)
+    data = {
+        'assigned_devices': {10058400: ['frontdoor (425036451)']},
+        'deactivated_cards': {10058400: False},
+    }
+
+    assert cache.set('global_cards_aggregated', data)
+    # Read back from the table, not this worker's memo
+    cache._memo.clear()
+    assert cache.get('global_cards_aggregated') == {
+        'assigned_devices': {'10058400': ['frontdoor (425036451)']},
+        'deactivated_cards': {'10058400': False},
+    }
+    assert cache.stats['errors'] == 0
@@ -0,0 +1,58 @@
+import multiprocessing
+import time
+
+import pytest
+from flask import Flask
+
+import doorctl.db
+from doorctl.db import CardMemberMapping, card_lookup, db, init_db
+from doorctl.sharedlib.cache import MEMO_TTL, CacheManager
+
+
+def make_app(db_path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
+    init_db(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def add_card_in_other_worker(db_path, cache_dir, card_number, name):
+    """Runs in a separate process, like another gunicorn worker"""
+    doorctl.db.cache_manager = CacheManager(cache_dir=cache_dir)
+    app = make_app(db_path)
+    with app.app_context():
+        db.session.add(CardMemberMapping(card_number=card_number, name=name))
+        db.session.commit()
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.setattr(doorctl.db, 'cache_manager', CacheManager(cache_dir=tmp_path / 'cache'))
+    return make_app(tmp_path / 'doorctl.db')
+
+
+def test_card_lookup_sees_commit_from_this_process(app):
+    with app.app_context():
+        assert 10058400 not in card_lookup()
+        db.session.add(CardMemberMapping(card_number=10058400, name='Zach'))
+        db.session.commit()
+        assert card_lookup()[10058400][0] == 'Zach'
+
+
+def test_card_lookup_sees_commit_from_another_process(app, tmp_path):
+    with app.app_context():
+        assert 10058401 not in card_lookup()
+
+        worker = multiprocessing.get_context('spawn').Process(
+            target=add_card_in_other_worker,
+            args=(tmp_path / 'doorctl.db', tmp_path / 'cache', 10058401, 'Ada')
+        )
+        worker.start()
+        worker.join(30)
+        assert worker.exitcode == 0
+
+        # The shared version token is memoized per worker for up to MEMO_TTL
+        time.sleep(MEMO_TTL + 0.1)
+        assert card_lookup()[10058401][0] == 'Ada'
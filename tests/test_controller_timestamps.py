@@ -0,0 +1,33 @@
+import datetime
+import time
+
+import pytest
+
+from doorctl.blueprints.doorctl import controller_timestamp_to_utc
+
+
+@pytest.fixture
+def new_york_host(monkeypatch):
+    """Run the test with America/New_York as the host's local zone"""
+    monkeypatch.setenv('TZ', 'America/New_York')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize('zone', ['UTC', 'GMT'])
+def test_utc_stamp_is_taken_as_utc(new_york_host, zone):
+    assert controller_timestamp_to_utc(f'2024-05-01 10:00:00 {zone}') == \
+        datetime.datetime(2024, 5, 1, 10, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def test_local_zone_stamp_is_read_as_local_time(new_york_host):
+    # EDT is UTC-4 on 1 May
+    assert controller_timestamp_to_utc('2024-05-01 10:00:00 EDT') == \
+        datetime.datetime(2024, 5, 1, 14, 0, 0, tzinfo=datetime.timezone.utc)
+
+
+def test_unknown_zone_raises(new_york_host):
+    with pytest.raises(ValueError):
+        controller_timestamp_to_utc('2024-05-01 10:00:00 CEST')
@@ -0,0 +1,47 @@
+import datetime
+
+import pytest
+from flask import Flask
+
+from doorctl.blueprints.doorctl import doorctl
+from doorctl.db import GlobalEventLog, db, init_db
+
+BASE_TS = datetime.datetime(2024, 5, 1, 10, 0, 0)
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config.update(REST_ENDPOINT='http://127.0.0.1:8080/uhppote', ENABLE_PROXY_DETECTION=False,
+                      ENABLE_PROXIED_SECURIY_KEY=False,
+                      SQLALCHEMY_DATABASE_URI=f'sqlite:///{tmp_path / "doorctl.db"}')
+    app.register_blueprint(doorctl)
+    init_db(app)
+    with app.app_context():
+        db.create_all()
+        # Inserted out of time order, so id order and time order differ
+        db.session.add_all(
+            GlobalEventLog(controller_id=425036451, event_id=event_id, door_id=1,
+                           timestamp_utc=BASE_TS + datetime.timedelta(minutes=minutes))
+            for event_id, minutes in ((1, 5), (2, 1), (3, 9), (4, 3))
+        )
+        db.session.commit()
+    return app
+
+
+def test_event_log_pages_start_with_the_newest_events(app):
+    client = app.test_client()
+
+    first = client.get('/accesscontrol/get_events_in_log?page=1&per_page=2').json
+    second = client.get('/accesscontrol/get_events_in_log?page=2&per_page=2').json
+
+    assert [event['event_id'] for event in first['events']] == [3, 1]
+    assert [event['event_id'] for event in second['events']] == [4, 2]
+    assert first['pagination']['total'] == 4
+
+
+def test_event_log_by_doors_is_newest_first(app):
+    response = app.test_client().get('/accesscontrol/get_events_in_log_by_doors/controller/425036451/doors/1')
+
+    assert [event['event_id'] for event in response.json['events']] == [3, 1, 4, 2]
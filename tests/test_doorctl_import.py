@@ -0,0 +1,72 @@
+import io
+
+import orjson
+import pytest
+from flask import Flask
+
+import doorctl.blueprints.api as api_module
+from doorctl.blueprints.doorctl import doorctl
+from doorctl.db import CardMemberMapping, db, init_db
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config.update(REST_ENDPOINT='http://127.0.0.1:8080/uhppote', ENABLE_PROXY_DETECTION=False,
+                      ENABLE_PROXIED_SECURIY_KEY=False,
+                      SQLALCHEMY_DATABASE_URI=f'sqlite:///{tmp_path / "doorctl.db"}')
+    app.register_blueprint(doorctl)
+    init_db(app)
+    with app.app_context():
+        db.create_all()
+        db.session.add(CardMemberMapping(card_number=1, name='Existing'))
+        db.session.commit()
+    return app
+
+
+def upload(app, document, mode='merge'):
+    """POST document to the import form, returning the flashed (category, message) pairs"""
+    client = app.test_client()
+    response = client.post('/accesscontrol/data/import', data={
+        'import_file': (io.BytesIO(orjson.dumps(document)), 'export.json'),
+        'import_mode': mode,
+    })
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        return session.get('_flashes', [])
+
+
+def card_numbers(app):
+    with app.app_context():
+        return sorted(card.card_number for card in CardMemberMapping.query.all())
+
+
+@pytest.mark.parametrize('document', [
+    [],
+    {'users': {'card_number': 2}},
+    {'users': [{'card_number': 2}, 'oops']},
+    {'users': [], 'events': [None]},
+])
+def test_malformed_upload_is_rejected_before_anything_is_written(app, document):
+    flashes = upload(app, document, mode='replace')
+
+    assert [category for category, _ in flashes] == ['danger']
+    assert flashes[0][1].startswith('Invalid import file')
+    # Replace mode did not clear the existing data
+    assert card_numbers(app) == [1]
+
+
+def test_failed_batch_reports_what_was_already_imported(app, monkeypatch):
+    monkeypatch.setattr(api_module, 'IMPORT_BATCH_SIZE', 2)
+    # The second batch repeats a card number, which the plain INSERT of
+    # replace mode rejects after the first batch was committed
+    users = [{'card_number': n} for n in (10, 11, 12, 12)]
+
+    flashes = upload(app, {'users': users}, mode='replace')
+
+    category, message = flashes[-1]
+    assert category == 'danger'
+    assert message.startswith('Failed to import data')
+    assert 'Already imported before the error: 2 users (0 skipped), 0 events (0 skipped)' in message
+    assert card_numbers(app) == [10, 11]
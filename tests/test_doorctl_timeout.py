@@ -0,0 +1,48 @@
+import pytest
+import requests
+from flask import Flask
+
+from doorctl.blueprints.doorctl import controller_timeout, doorctl
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config['REST_ENDPOINT'] = 'http://127.0.0.1:8080/uhppote'
+    app.register_blueprint(doorctl)
+    return app
+
+
+def timeout_redirect(app, referrer):
+    headers = {'Referer': referrer} if referrer else {}
+    with app.test_request_context('/accesscontrol/controller/1/add_card', method='POST',
+                                  base_url='http://door.example', headers=headers):
+        response = controller_timeout(requests.exceptions.Timeout('timed out'))
+    assert response.status_code == 302
+    return response.headers['Location']
+
+
+def test_timeout_redirects_back_to_same_host_page(app):
+    assert timeout_redirect(app, 'http://door.example/accesscontrol/controller/1/cards?x=1') == \
+        '/accesscontrol/controller/1/cards?x=1'
+
+
+@pytest.mark.parametrize('referrer', [
+    'https://evil.example/phish',
+    'http://door.example.evil.example/',
+    'javascript:alert(1)',
+    None,
+])
+def test_timeout_never_redirects_off_host(app, referrer):
+    assert timeout_redirect(app, referrer) == '/accesscontrol/'
+
+
+def test_timeout_referrer_path_cannot_become_scheme_relative(app):
+    assert timeout_redirect(app, 'http://door.example//evil.example/x') == '/evil.example/x'
+
+
+def test_timeout_on_get_returns_504(app):
+    with app.test_request_context('/accesscontrol/controller/1/cards', base_url='http://door.example'):
+        assert controller_timeout(requests.exceptions.Timeout('timed out')) == \
+            ('The controller did not respond in time', 504)